@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Compare the pyparsing based parse_molden_mos with parse_molden_mos_np
+and check scan_mo_headers against both."""
+
+import argparse
+import time
+
+import numpy as np
+
+from qchelper.molden import (parse_molden_mos, parse_molden_mos_np,
+                             scan_mo_headers)
+
+
+def make_mo_text(mo_num, ao_num, ao_counts=None):
+    """ao_counts optionally holds the number of coefficient lines written
+    for every MO, so the blocks can differ in length."""
+    rng = np.random.default_rng(0)
+    blocks = list()
+    for i in range(mo_num):
+        coeffs = rng.uniform(-1, 1, ao_num)
+        ao_indices = np.arange(1, ao_num+1)
+        if ao_counts is not None:
+            keep = np.sort(rng.choice(ao_num, ao_counts[i], replace=False))
+            coeffs, ao_indices = coeffs[keep], ao_indices[keep]
+        ao_lines = "\n".join([f"{j:4d} {c: .6f}"
+                              for j, c in zip(ao_indices, coeffs)])
+        spin = "Alpha" if i < mo_num // 2 else "Beta"
+        blocks.append(f"Ene= {rng.uniform(-20, 5): .6f}\n"
+                      f"Spin= {spin}\n"
+                      f"Occup= {2.0 if i < mo_num // 4 else 0.0: .6f}\n"
+                      f"{ao_lines}")
+    return "\n".join(blocks) + "\n"
+
+
+def check_headers(mo_num, ao_num):
+    """scan_mo_headers has to find every MO, also when the blocks differ in
+    length."""
+    rng = np.random.default_rng(1)
+    texts = [make_mo_text(mo_num, ao_num, ao_counts) for ao_counts
+             in (None, rng.integers(1, ao_num+1, mo_num))]
+    # All lines have the same width and a header is as long as four
+    # coefficient lines. Skipping the coefficients of the first block from
+    # the end of the second header lands exactly on the fourth MO.
+    blocks = list()
+    for i, ao_count in enumerate((10, 3, 3, 3, 10), 1):
+        header = [f"Sym= {i}a", f"Ene= {-i:.2f}", "Spin= Alpha",
+                  f"Occup= {i/10:.2f}"]
+        ao_lines = [f"{j:4d} {0.5: .6f}" for j in range(1, ao_count+1)]
+        blocks.extend([line.ljust(14) for line in header + ao_lines])
+    texts.append("\n".join(blocks) + "\n")
+    for text in texts:
+        mos_np = parse_molden_mos_np(text)
+        for buf in (text, text.encode()):
+            headers = scan_mo_headers(buf)
+            np.testing.assert_allclose(headers["energy"], mos_np.energies)
+            np.testing.assert_allclose(headers["occup"], mos_np.occups)
+            assert list(headers["spin"]) == list(mos_np.spins)
+
+
+def timed(func, arg):
+    start = time.perf_counter()
+    result = func(arg)
+    return result, time.perf_counter() - start
+
+
+def run(mo_num, ao_num):
+    check_headers(mo_num, ao_num)
+    text = make_mo_text(mo_num, ao_num)
+    mos_pp, dur_pp = timed(parse_molden_mos, text)
+    mos_np, dur_np = timed(parse_molden_mos_np, text)
+
+    np.testing.assert_allclose(mos_np.energies, [mo.energy for mo in mos_pp])
+    np.testing.assert_allclose(mos_np.occups, [mo.occup for mo in mos_pp])
+    assert list(mos_np.spins) == [mo.spin for mo in mos_pp]
+    np.testing.assert_allclose(mos_np.coeffs,
+                               [list(mo.coeffs) for mo in mos_pp])
+
+    print(f"{mo_num:>5d} MOs x {ao_num:>5d} AOs: "
+          f"parse_molden_mos {dur_pp:8.3f} s, "
+          f"parse_molden_mos_np {dur_np:8.3f} s, "
+          f"speedup {dur_pp/dur_np:6.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for size in args.sizes:
+        run(size, size)
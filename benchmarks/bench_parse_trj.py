@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""Compare the per-frame trj parser with the bulk parser."""
+
+import argparse
+import time
+
+import numpy as np
+
+from qchelper.geometry import make_trj_str, parse_trj_str, parse_trj_str_bulk
+
+
+def best_of(func, arg, repeat):
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(atom_num, frame_num, repeat):
+    atoms = ["C", "H", "N", "O"] * (atom_num // 4) + ["H"] * (atom_num % 4)
+    coords = np.random.default_rng(0).uniform(-10, 10,
+                                              (frame_num, atom_num, 3))
+    trj_str = make_trj_str(atoms, coords)
+
+    _, bulk_coords, _ = parse_trj_str_bulk(trj_str)
+    ref_coords = np.array([c for _, c in parse_trj_str(trj_str)])
+    np.testing.assert_allclose(bulk_coords, ref_coords)
+
+    per_frame = best_of(parse_trj_str, trj_str, repeat)
+    bulk = best_of(parse_trj_str_bulk, trj_str, repeat)
+    print(f"{frame_num:>7d} frames x {atom_num:>4d} atoms: "
+          f"parse_trj_str {per_frame:8.4f} s, "
+          f"parse_trj_str_bulk {bulk:8.4f} s, "
+          f"speedup {per_frame/bulk:5.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    for atom_num, frame_num in ((3, 50000), (20, 10000), (100, 2000)):
+        run(atom_num, frame_num, args.repeat)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
 import chemcoord as cc
 import numpy as np
 
@@ -8,6 +10,40 @@ def get_centered_location(cart):
     cartm[:, "x":"z"] = cartm[:,"x":"z"] - cartm.topologic_center()
     return cartm.location()
 
+def kabsch_rotations(coords1, coords2):
+    """Batched Kabsch algorithm.
+
+    Parameters
+    ----------
+    coords1 : np.array
+        Shape (..., N, 3), centered reference coordinates.
+    coords2 : np.array
+        Shape (..., N, 3), centered coordinates to be rotated.
+
+    Returns
+    -------
+    U : np.array
+        Shape (..., 3, 3). Rotation matrices, so that coords2 @ U is
+        superimposed on coords1.
+    """
+    H = np.swapaxes(coords2, -1, -2) @ coords1
+    V, _, Wt = np.linalg.svd(H)
+    # Avoid improper rotations (reflections)
+    d = np.sign(np.linalg.det(V @ Wt))
+    V[..., :, -1] *= d[..., None]
+    return V @ Wt
+
+
+def kabsch_rmsds(coords1, coords2):
+    """RMSDs of (..., N, 3) coordinate arrays after optimal superposition
+    of coords2 on coords1."""
+    coords1 = coords1 - coords1.mean(axis=-2, keepdims=True)
+    coords2 = coords2 - coords2.mean(axis=-2, keepdims=True)
+    U = kabsch_rotations(coords1, coords2)
+    diff = coords2 @ U - coords1
+    return np.sqrt((diff**2).sum(axis=(-2, -1)) / coords1.shape[-2])
+
+
 def subalign(structure1, structure2):
     # Unpack the structure tuples into a Cartesian and an index mask.
     cart1, mask1 = structure1
@@ -34,6 +70,249 @@ def subalign(structure1, structure2):
 
     return cart1m, cart2m
 
+def align_trajectory(ref_coords, coords, mask=None):
+    """Superimpose every frame of a trajectory on a reference.
+
+    Like in subalign the superposition is determined from a substructure,
+    but all frames are handled in one batched SVD.
+
+    Parameters
+    ----------
+    ref_coords : array_like
+        Shape (N, 3) reference coordinates.
+    coords : array_like
+        Shape (M, N, 3) coordinates of M frames.
+    mask : array_like, optional
+        Index or boolean mask selecting the substructure used for the
+        superposition. All atoms are used if not given.
+
+    Returns
+    -------
+    aligned : np.array
+        Shape (M, N, 3). All atoms of every frame, rotated and translated
+        onto the reference.
+    rmsds : np.array
+        Shape (M, ). RMSD of the substructure for every frame.
+    """
+    ref_coords = np.asarray(ref_coords, dtype=float)
+    coords = np.asarray(coords, dtype=float)
+    if mask is None:
+        mask = slice(None)
+
+    ref_sub = ref_coords[mask]
+    ref_center = ref_sub.mean(axis=0)
+    centers = coords[:, mask].mean(axis=1, keepdims=True)
+    U = kabsch_rotations(ref_sub - ref_center, coords[:, mask] - centers)
+    aligned = (coords - centers) @ U + ref_center
+    diff = aligned[:, mask] - ref_sub
+    rmsds = np.sqrt((diff**2).sum(axis=2).mean(axis=1))
+    return aligned, rmsds
+
+
+def qcp_rmsds(M, E0, atom_num, max_iter=50, eval_prec=1e-11):
+    """Minimum RMSDs from the quaternion characteristic polynomial (QCP).
+
+    The largest eigenvalue of the 4x4 key matrix is found by Newton-Raphson
+    on its characteristic polynomial, so no rotation matrix is needed
+    (Theobald, Acta Cryst. A 2005, 61, 478; Liu et al., J. Comput. Chem.
+    2010, 31, 1561).
+
+    Parameters
+    ----------
+    M : np.array
+        Shape (K, 3, 3). Inner product matrices A.T @ B of K pairs of
+        centered coordinates.
+    E0 : np.array
+        Shape (K, ). Half the sum of the squared norms of A and B.
+    atom_num : int
+        Number of atoms in every structure.
+
+    Returns
+    -------
+    rmsds : np.array
+        Shape (K, ).
+    """
+    Sxx, Sxy, Sxz = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+    Syx, Syy, Syz = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+    Szx, Szy, Szz = M[:, 2, 0], M[:, 2, 1], M[:, 2, 2]
+
+    Sxx2, Syy2, Szz2 = Sxx**2, Syy**2, Szz**2
+    Sxy2, Syz2, Sxz2 = Sxy**2, Syz**2, Sxz**2
+    Syx2, Szy2, Szx2 = Syx**2, Szy**2, Szx**2
+
+    SyzSzymSyySzz2 = 2.0*(Syz*Szy - Syy*Szz)
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2
+
+    C2 = -2.0 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2)
+    C1 = 8.0 * (Sxx*Syz*Szy + Syy*Szx*Sxz + Szz*Sxy*Syx
+                - Sxx*Syy*Szz - Syz*Szx*Sxy - Szy*Syx*Sxz)
+
+    SxzpSzx = Sxz + Szx
+    SyzpSzy = Syz + Szy
+    SxypSyx = Sxy + Syx
+    SyzmSzy = Syz - Szy
+    SxzmSzx = Sxz - Szx
+    SxymSyx = Sxy - Syx
+    SxxpSyy = Sxx + Syy
+    SxxmSyy = Sxx - Syy
+    Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2
+
+    C0 = (Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2
+          + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2)
+          * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2)
+          + (-SxzpSzx*SyzmSzy + SxymSyx*(SxxmSyy - Szz))
+          * (-SxzmSzx*SyzpSzy + SxymSyx*(SxxmSyy + Szz))
+          + (-SxzpSzx*SyzpSzy - SxypSyx*(SxxpSyy - Szz))
+          * (-SxzmSzx*SyzmSzy - SxypSyx*(SxxpSyy + Szz))
+          + (SxypSyx*SyzpSzy + SxzpSzx*(SxxmSyy + Szz))
+          * (-SxymSyx*SyzmSzy + SxzpSzx*(SxxpSyy + Szz))
+          + (SxypSyx*SyzmSzy + SxzmSzx*(SxxmSyy - Szz))
+          * (-SxymSyx*SyzpSzy + SxzmSzx*(SxxpSyy - Szz)))
+
+    # Newton-Raphson, starting from the upper bound E0
+    eig = E0.copy()
+    for _ in range(max_iter):
+        eig_prev = eig
+        x2 = eig*eig
+        b = (x2 + C2)*eig
+        a = b + C1
+        denom = 2.0*x2*eig + b + a
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = np.where(denom != 0.0, (a*eig + C0)/denom, 0.0)
+        eig = eig - delta
+        if np.all(np.abs(eig - eig_prev) <= np.abs(eval_prec*eig)):
+            break
+    return np.sqrt(np.abs(2.0 * (E0 - eig) / atom_num))
+
+
+def _center(coords, mask=None):
+    coords = np.asarray(coords, dtype=float)
+    if mask is not None:
+        coords = coords[:, mask]
+    coords = coords - coords.mean(axis=1, keepdims=True)
+    # Half of the squared norm of every structure
+    half_sq_norms = 0.5 * (coords**2).sum(axis=(1, 2))
+    return coords, half_sq_norms
+
+
+def _rmsd_rows(coords, half_sq_norms, start, end):
+    """Condensed RMSD matrix entries of the rows start to end-1."""
+    atom_num = coords.shape[1]
+    rows = list()
+    for i in range(start, end):
+        M = np.einsum("na,mnb->mab", coords[i], coords[i+1:])
+        E0 = half_sq_norms[i] + half_sq_norms[i+1:]
+        rows.append(qcp_rmsds(M, E0, atom_num))
+    return start, np.concatenate(rows) if rows else np.empty(0)
+
+
+_WORKER_DATA = dict()
+
+
+def _init_worker(coords, half_sq_norms):
+    _WORKER_DATA["coords"] = coords
+    _WORKER_DATA["half_sq_norms"] = half_sq_norms
+
+
+def _rmsd_rows_worker(start, end):
+    return _rmsd_rows(_WORKER_DATA["coords"], _WORKER_DATA["half_sq_norms"],
+                      start, end)
+
+
+def _row_blocks(structure_num, block_size):
+    """Split the rows of the upper triangle in blocks holding roughly
+    block_size pairs each."""
+    blocks = list()
+    start = 0
+    pairs = 0
+    for i in range(structure_num):
+        pairs += structure_num - i - 1
+        if pairs >= block_size:
+            blocks.append((start, i+1))
+            start = i+1
+            pairs = 0
+    if start < structure_num:
+        blocks.append((start, structure_num))
+    return blocks
+
+
+def pairwise_rmsd(coords, mask=None, workers=1, block_size=1000000,
+                  out_fn=None):
+    """All-vs-all RMSD matrix of a conformer ensemble.
+
+    The RMSDs after optimal superposition of the substructures given by
+    mask are computed with the QCP method. The upper triangle is split into
+    blocks of rows that are distributed over a process pool.
+
+    Parameters
+    ----------
+    coords : array_like
+        Shape (M, N, 3) coordinates of M conformers.
+    mask : array_like, optional
+        Index or boolean mask selecting the substructure. All atoms are
+        used if not given.
+    workers : int, optional
+        Number of worker processes. With 1 everything is calculated in
+        the current process.
+    block_size : int, optional
+        Approximate number of pairs calculated per block.
+    out_fn : str, optional
+        If given, the result is written to a memory-mapped float64 file
+        instead of being kept in memory.
+
+    Returns
+    -------
+    rmsds : np.array
+        Condensed RMSD matrix of shape (M*(M-1)/2, ) in the ordering of
+        scipy.spatial.distance.squareform.
+    """
+    coords, half_sq_norms = _center(coords, mask)
+    structure_num = len(coords)
+    pair_num = structure_num * (structure_num - 1) // 2
+    if out_fn is None:
+        rmsds = np.zeros(pair_num)
+    else:
+        rmsds = np.memmap(out_fn, dtype=np.float64, mode="w+",
+                          shape=(pair_num, ))
+
+    def row_offset(i):
+        return i*structure_num - i*(i+1)//2
+
+    def store(start, block):
+        offset = row_offset(start)
+        rmsds[offset:offset+block.size] = block
+
+    def store_done(pending):
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            store(*future.result())
+        return pending
+
+    blocks = _row_blocks(structure_num, block_size)
+    if workers == 1:
+        for start, end in blocks:
+            store(*_rmsd_rows(coords, half_sq_norms, start, end))
+    else:
+        # Only a few blocks are in flight at a time and every finished future
+        # is dropped after its block was stored, so the parent never holds
+        # more than a few blocks besides rmsds.
+        max_pending = 2 * workers
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(coords, half_sq_norms)) as pool:
+            pending = set()
+            for start, end in blocks:
+                if len(pending) >= max_pending:
+                    pending = store_done(pending)
+                pending.add(pool.submit(_rmsd_rows_worker, start, end))
+            while pending:
+                pending = store_done(pending)
+
+    if out_fn is not None:
+        rmsds.flush()
+    return rmsds
+
+
 if __name__ == "__main__":
     mask1 = [32, 33, 37, 38, 39, 40]
     mask2 = [30, 31, 35, 36, 37, 38]
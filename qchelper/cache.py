@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""Binary on-disk cache for arrays parsed from text files.
+
+A cache file starts with a magic string and the length of a JSON header.
+The header holds the signature of the source file, arbitrary metadata and
+the dtype, shape and byte offset of every stored array. The arrays follow
+as raw, 64 byte aligned data, so they can be memory-mapped without copying.
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"QCHCACHE"
+VERSION = 1
+ALIGN = 64
+CACHE_EXT = ".qcc"
+
+
+def hash_file(fn, chunk_size=1 << 20):
+    """Returns the SHA-256 hex digest of a file."""
+    sha = hashlib.sha256()
+    with open(fn, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_signature(fn, with_hash=True):
+    """Returns a dict holding size, mtime and (optionally) the content hash
+    of a file."""
+    stat = os.stat(fn)
+    signature = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if with_hash:
+        signature["sha256"] = hash_file(fn)
+    return signature
+
+
+def compare_signature(signature, fn, check_hash=True):
+    """Check if fn still matches a signature created by file_signature.
+
+    A different size always means a changed file and an unchanged size and
+    mtime an unchanged one; no hash is calculated in both cases. If only
+    the mtime differs, the file may just have been touched or copied. With
+    check_hash its SHA-256 decides then, otherwise it counts as changed.
+
+    Returns
+    -------
+    unchanged : bool
+        Whether the content of fn still matches the signature.
+    current : dict
+        Current signature of fn. Only holds "sha256" if the hash had to be
+        calculated.
+    """
+    current = file_signature(fn, with_hash=False)
+    if current["size"] != signature["size"]:
+        return False, current
+    if current["mtime_ns"] == signature["mtime_ns"]:
+        return True, current
+    if not check_hash:
+        return False, current
+    current["sha256"] = hash_file(fn)
+    return current["sha256"] == signature["sha256"], current
+
+
+def get_cache_fn(src_fn, kind, cache_dir=None):
+    """Path of the cache file belonging to src_fn.
+
+    Without a cache_dir the cache is written as a hidden sidecar file next
+    to the source. Inside a cache_dir the absolute path of the source is
+    hashed to avoid name clashes.
+    """
+    src_fn = os.path.abspath(src_fn)
+    dirname, basename = os.path.split(src_fn)
+    if cache_dir is None:
+        return os.path.join(dirname, f".{basename}.{kind}{CACHE_EXT}")
+    path_hash = hashlib.sha1(src_fn.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{path_hash}_{basename}.{kind}{CACHE_EXT}")
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_cache(cache_fn, arrays, meta):
+    """Write a dict of arrays and a JSON-serializable meta dict to cache_fn.
+
+    The file is written to a temporary path first and then moved into
+    place, so readers never see a partially written cache.
+    """
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+    array_specs = dict()
+    offset = 0
+    for name, arr in arrays.items():
+        array_specs[name] = {
+            "dtype": arr.dtype.str,
+            "shape": arr.shape,
+            "offset": offset,
+        }
+        offset = _align(offset + arr.nbytes)
+    header = json.dumps({
+        "version": VERSION,
+        "meta": meta,
+        "arrays": array_specs,
+    }).encode()
+    # Data starts at an aligned offset after magic, length and header
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    header = header.ljust(data_start - len(MAGIC) - 8)
+
+    tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, "wb") as handle:
+        handle.write(MAGIC)
+        handle.write(struct.pack("<Q", len(header)))
+        handle.write(header)
+        for name, arr in arrays.items():
+            handle.seek(data_start + array_specs[name]["offset"])
+            handle.write(arr.tobytes())
+    os.replace(tmp_fn, cache_fn)
+
+
+def read_header(cache_fn):
+    """Returns the decoded JSON header and the offset of the data block."""
+    with open(cache_fn, "rb") as handle:
+        if handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{cache_fn}' is not a qchelper cache file.")
+        header_len, = struct.unpack("<Q", handle.read(8))
+        header = json.loads(handle.read(header_len).decode())
+    return header, len(MAGIC) + 8 + header_len
+
+
+def read_cache(cache_fn):
+    """Read a cache file written by write_cache.
+
+    Returns
+    -------
+    arrays : dict
+        Read-only arrays memory-mapped from the cache file.
+    meta : dict
+        The metadata stored alongside the arrays.
+    """
+    header, data_start = read_header(cache_fn)
+    arrays = dict()
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        # np.memmap can't map zero bytes
+        if dtype.itemsize * int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+            continue
+        arrays[name] = np.memmap(cache_fn, dtype=dtype, mode="r",
+                                 offset=data_start + spec["offset"],
+                                 shape=shape)
+    return arrays, header["meta"]
+
+
+def is_valid(cache_fn, src_fn, check_hash=True):
+    """Check if the source signature stored in cache_fn still matches
+    src_fn, see compare_signature."""
+    try:
+        header, data_start = read_header(cache_fn)
+    except (OSError, ValueError):
+        return False
+    if header.get("version") != VERSION:
+        return False
+    signature = header["meta"]["source"]
+    unchanged, current = compare_signature(signature, src_fn, check_hash)
+    if unchanged and (current["mtime_ns"] != signature["mtime_ns"]):
+        # The content was confirmed by its hash. Store the new mtime, so
+        # later checks don't have to hash the source again.
+        signature["mtime_ns"] = current["mtime_ns"]
+        _rewrite_header(cache_fn, header, data_start)
+    return unchanged
+
+
+def _rewrite_header(cache_fn, header, data_start):
+    """Overwrite the header of cache_fn in place. Nothing is done if the new
+    header doesn't fit into the space of the old one."""
+    header_len = data_start - len(MAGIC) - 8
+    new_header = json.dumps(header).encode()
+    if len(new_header) > header_len:
+        return
+    with open(cache_fn, "r+b") as handle:
+        handle.seek(len(MAGIC) + 8)
+        handle.write(new_header.ljust(header_len))
+
+
+def evict_lru(cache_dir, max_bytes, keep=()):
+    """Delete the least recently used cache files in cache_dir until their
+    total size drops below max_bytes. Files in keep are never deleted."""
+    entries = list()
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(CACHE_EXT):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    keep = [os.path.abspath(fn) for fn in keep]
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def load_cached(src_fn, kind, build, cache_dir=None, max_bytes=None,
+                check_hash=True):
+    """Load the arrays derived from src_fn from the cache or create them.
+
+    Parameters
+    ----------
+    src_fn : str
+        Path to the source file.
+    kind : str
+        Short name of the cached content, e.g. "trj". Becomes part of the
+        cache filename.
+    build : callable
+        Called as build(src_fn) on a cache miss. Has to return a dict of
+        arrays and a JSON-serializable meta dict.
+    cache_dir : str, optional
+        Directory holding the cache files. If not given the cache is
+        written next to the source file.
+    max_bytes : int, optional
+        Size limit of cache_dir. The least recently used files are
+        evicted when it is exceeded.
+    check_hash : bool, optional
+        If only the mtime of the source changed, compare its SHA-256 to
+        decide if the cache is still valid, see compare_signature. Without
+        check_hash a changed mtime always invalidates the cache.
+
+    Returns
+    -------
+    arrays : dict
+        Arrays memory-mapped from the cache file.
+    meta : dict
+        Metadata returned by build.
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    cache_fn = get_cache_fn(src_fn, kind, cache_dir)
+
+    if is_valid(cache_fn, src_fn, check_hash):
+        # Bump the mtime, as it is used for the LRU eviction
+        os.utime(cache_fn)
+    else:
+        signature = file_signature(src_fn)
+        arrays, meta = build(src_fn)
+        meta = dict(meta, source=signature)
+        write_cache(cache_fn, arrays, meta)
+        if (cache_dir is not None) and (max_bytes is not None):
+            evict_lru(cache_dir, max_bytes, keep=(cache_fn, ))
+
+    arrays, meta = read_cache(cache_fn)
+    del meta["source"]
+    return arrays, meta
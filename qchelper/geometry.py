@@ -1,37 +1,185 @@
+from collections.abc import Sequence
+import io
+import os
+
 import numpy as np
 from pandas import DataFrame
 
 import chemcoord as cc
 
+from qchelper.alignment import kabsch_rmsds
+from qchelper.cache import load_cached
 
-def get_coords_diffs(coords_list, normalize=False):
-    cds = [0, ]
-    for i in range(len(coords_list)-1):
-        diff = np.linalg.norm(coords_list[i+1]-coords_list[i])
-        cds.append(diff)
-    cds = np.cumsum(cds)
+
+def _atomic_steps(coords, metric, masses=None, mask=None):
+    """Distances between consecutive images for the metrics working on
+    (M, N, 3) coordinates, see get_path_lengths."""
+    coords = coords.reshape(len(coords), -1, 3)
+    if masses is not None:
+        masses = np.asarray(masses, dtype=float)
+    if mask is not None:
+        coords = coords[:, mask]
+        if masses is not None:
+            masses = masses[mask]
+
+    if metric == "aligned_rmsd":
+        return kabsch_rmsds(coords[:-1], coords[1:])
+    # Squared displacement of every atom between consecutive images
+    sq_diffs = ((coords[1:] - coords[:-1])**2).sum(axis=2)
+    if metric == "cartesian":
+        return np.sqrt(sq_diffs.sum(axis=1))
+    elif metric == "mass_weighted":
+        if masses is None:
+            raise ValueError("metric='mass_weighted' requires masses!")
+        return np.sqrt((sq_diffs * masses).sum(axis=1))
+    elif metric == "rmsd":
+        return np.sqrt(sq_diffs.mean(axis=1))
+    raise ValueError(f"Unknown metric '{metric}'!")
+
+
+def get_path_lengths(coords, metric="cartesian", masses=None, mask=None,
+                     normalize=False):
+    """Cumulative arc length along a path of geometries.
+
+    Parameters
+    ----------
+    coords : array_like
+        Shape (M, N, 3) holding the coordinates of M images with N atoms.
+        For metric="cartesian" without a mask the images may have any
+        (equal) shape, as only the norm of their difference is used.
+    metric : str, optional
+        Distance between two consecutive images. One of
+            "cartesian": norm of the coordinate difference,
+            "mass_weighted": norm of the mass-weighted difference,
+            "rmsd": root mean square deviation per atom,
+            "aligned_rmsd": RMSD after optimal superposition.
+    masses : array_like, optional
+        Shape (N, ) atomic masses. Required for metric="mass_weighted".
+    mask : array_like, optional
+        Index or boolean mask restricting the metric to a subset of the
+        atoms, e.g. the reaction center.
+    normalize : bool, optional
+        Scale the path lengths to [0, 1].
+
+    Returns
+    -------
+    path_lengths : np.array
+        Shape (M, ). Cumulative path length, starting at 0.
+    """
+    coords = np.asarray(coords, dtype=float)
+    if (metric == "cartesian") and (mask is None):
+        # Only the norm of the flattened difference is needed, so images of
+        # any shape are accepted, e.g. vectors whose length isn't a multiple
+        # of 3.
+        coords = coords.reshape(len(coords), -1)
+        steps = np.linalg.norm(coords[1:] - coords[:-1], axis=1)
+    else:
+        steps = _atomic_steps(coords, metric, masses, mask)
+
+    path_lengths = np.zeros(len(coords))
+    path_lengths[1:] = np.cumsum(steps)
     if normalize:
-        cds /= cds.max()
-    return cds
+        path_lengths /= path_lengths.max()
+    return path_lengths
+
+
+def get_coords_diffs(coords_list, normalize=False):
+    return get_path_lengths(coords_list, normalize=normalize)
+
+
+def _frame_fmt(atom_num):
+    """%-style format string of one xyz frame. It expects the number of atoms,
+    the comment and (atom, x, y, z) for every atom as arguments."""
+    # Same layout as the former "{:>3s} " + "{: 03.8f}" per coordinate
+    line_fmt = "%3s % 03.8f % 03.8f % 03.8f"
+    return "\n".join(["%d\n%s", ] + [line_fmt, ]*atom_num)
+
+
+def format_trj_frames(atoms, coords, comments=""):
+    """Format several frames at once.
+
+    All frames are formatted in one %-operation, so no Python loop over
+    atoms or frames is needed.
+
+    Paramters
+    ---------
+    atoms : iterable
+        Element symbols of the N atoms.
+    coords : array_like
+        Shape (M, N, 3) holding the coordinates of M frames.
+    comments : str or iterable of str, optional
+        Comment line used for all frames or one comment per frame.
+
+    Returns
+    -------
+    trj_str : str
+        The formatted frames, joined by newlines, without a trailing
+        newline.
+    """
+    coords = np.asarray(coords, dtype=float)
+    frame_num, atom_num, _ = coords.shape
+    assert(len(atoms) == atom_num)
+    if isinstance(comments, str):
+        comments = [comments, ]*frame_num
+    assert(len(comments) == frame_num)
+
+    args = np.empty((frame_num, 2 + 4*atom_num), dtype=object)
+    args[:, 0] = atom_num
+    args[:, 1] = comments
+    atoms_coords = args[:, 2:].reshape(frame_num, atom_num, 4)
+    atoms_coords[:, :, 0] = np.asarray(atoms, dtype=object)
+    atoms_coords[:, :, 1:] = coords
+    trj_fmt = "\n".join([_frame_fmt(atom_num), ]*frame_num)
+    return trj_fmt % tuple(args.ravel().tolist())
+
+
+def write_trj(handle, atoms, coords, comments="", chunk_size=1000,
+              continued=False):
+    """Write frames to an open text handle in chunks of chunk_size frames.
+
+    The output is identical to make_trj_str. If continued is True the handle
+    already holds frames, so a newline is written before the first frame.
+    """
+    coords = np.asarray(coords, dtype=float)
+    frame_num = len(coords)
+    if isinstance(comments, str):
+        comments = [comments, ]*frame_num
+    for start in range(0, frame_num, chunk_size):
+        end = start + chunk_size
+        if continued or (start > 0):
+            handle.write("\n")
+        handle.write(format_trj_frames(atoms, coords[start:end],
+                                       comments[start:end]))
+
+
+def write_trj_file(trj_fn, atoms, coords, comments="", chunk_size=1000,
+                   append=False):
+    """Write frames to trj_fn. With append=True the frames are added to an
+    existing file, so a trajectory can be extended incrementally."""
+    continued = False
+    if append and os.path.exists(trj_fn):
+        with open(trj_fn, "rb") as handle:
+            handle.seek(0, os.SEEK_END)
+            if handle.tell() > 0:
+                handle.seek(-1, os.SEEK_END)
+                # Only separate by a newline if the file doesn't already
+                # end with one.
+                continued = handle.read(1) != b"\n"
+    mode = "a" if append else "w"
+    with open(trj_fn, mode) as handle:
+        write_trj(handle, atoms, coords, comments, chunk_size, continued)
 
 
 def make_xyz_str(atoms, coords, comment=""):
     assert(len(atoms) == len(coords))
 
-    coord_fmt = "{: 03.8f}"
-    line_fmt = "{:>3s} " + " ".join([coord_fmt, ]*3)
-
-    body = [line_fmt.format(a, *xyz)
-            for a, xyz
-            in zip(atoms, coords)]
-    body = "\n".join(body)
- 
-    return "{}\n{}\n{}".format(len(atoms), comment, body)
+    return format_trj_frames(atoms, [coords, ], comment)
 
 
 def make_trj_str(atoms, coords_list):
-    xyz_strings = [make_xyz_str(atoms, coords) for coords in coords_list]
-    return "\n".join(xyz_strings)
+    handle = io.StringIO()
+    write_trj(handle, atoms, coords_list)
+    return handle.getvalue()
 
 
 def parse_xyz_str(xyz_str):
@@ -56,7 +204,7 @@ def parse_xyz_str(xyz_str):
                     for line in xyz_str.strip().split("\n")[2:]
     ]
     atoms, coords = zip(*[(a, c) for a, *c in atoms_coords])
-    coords = np.array(coords, dtype=np.float)
+    coords = np.array(coords, dtype=float)
     return atoms, coords
 
 
@@ -68,10 +216,107 @@ def parse_xyz_file(xyz_fn):
 
 
 def parse_trj_file(trj_fn):
-    with open(trj_fn) as handle:
-        trj_str = handle.read()
+    return list(iter_trj_file(trj_fn))
+
+
+def _read_xyz_frame(handle):
+    """Read one frame from a binary handle, starting at its current position.
+
+    Returns None when the end of the file is reached."""
+    atom_num_line = handle.readline()
+    # Skip blank lines, e.g. trailing newlines at the end of the file.
+    while atom_num_line and not atom_num_line.strip():
+        atom_num_line = handle.readline()
+    if not atom_num_line:
+        return None
+    atom_num = int(atom_num_line)
+    frame_lines = [atom_num_line, ] + [handle.readline()
+                                       for _ in range(atom_num+1)]
+    return parse_xyz_str(b"".join(frame_lines).decode())
+
+
+def iter_trj_file(trj_fn):
+    """Yield (atoms, coords) for every frame of a .trj file.
+
+    Only one frame is held in memory at a time."""
+    with open(trj_fn, "rb") as handle:
+        while True:
+            frame = _read_xyz_frame(handle)
+            if frame is None:
+                break
+            yield frame
+
+
+def index_trj_file(trj_fn):
+    """Get the byte offsets of the frame starts in a .trj file.
+
+    Paramters
+    ---------
+    trj_fn : str
+        Path to the .trj file.
+
+    Returns
+    -------
+    offsets : np.array
+        Integer array of shape (M, ) (M = number of frames) holding the
+        byte offset of the atom number line of every frame.
+    """
+    offsets = list()
+    with open(trj_fn, "rb") as handle:
+        while True:
+            offset = handle.tell()
+            line = handle.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            offsets.append(offset)
+            # Skip the comment and the coordinate lines
+            for _ in range(int(line)+1):
+                handle.readline()
+    return np.array(offsets, dtype=np.int64)
 
-    return parse_trj_str(trj_str)
+
+class TrjFile:
+    """Frame-indexed access to a .trj file.
+
+    The byte offsets of the frames are determined on first use, so
+    trj[i] and trj[start:stop:step] only parse the requested frames.
+    """
+
+    def __init__(self, trj_fn):
+        self.trj_fn = trj_fn
+        self._offsets = None
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = index_trj_file(self.trj_fn)
+        return self._offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return iter_trj_file(self.trj_fn)
+
+    def _read_frames(self, indices):
+        frames = list()
+        with open(self.trj_fn, "rb") as handle:
+            for index in indices:
+                handle.seek(self.offsets[index])
+                frames.append(_read_xyz_frame(handle))
+        return frames
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._read_frames(range(*key.indices(len(self))))
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not (0 <= index < len(self)):
+            raise IndexError("Frame index out of range.")
+        return self._read_frames((index, ))[0]
 
 
 def parse_trj_str(trj_str):
@@ -87,28 +332,153 @@ def parse_trj_str(trj_str):
     return xyzs
 
 
+def parse_trj_str_bulk(trj_str):
+    """Parse a trj string with equally sized frames into one array.
+
+    All coordinates are converted by a single np.loadtxt call instead of
+    calling parse_xyz_str for every frame.
+
+    Paramters
+    ---------
+    trj_str : str
+        The contents of a .trj file.
+
+    Returns
+    -------
+    atoms : np.array
+        Array of shape (N, ) (N = number of atoms) holding the
+        element symbols of the first frame.
+    coords : np.array
+        Contiguous float64 array of shape (M, N, 3) (M = number of frames)
+        holding the xyz coordinates.
+    comments : list
+        List of length M holding the comment line of every frame.
+    """
+    trj_lines = trj_str.strip().split("\n")
+    number_of_atoms = int(trj_lines[0].strip())
+    xyz_lines = number_of_atoms + 2
+    if len(trj_lines) % xyz_lines != 0:
+        raise ValueError("Frames in the trj string differ in size.")
+    number_of_frames = len(trj_lines) // xyz_lines
+    trj_lines = np.array(trj_lines, dtype=object).reshape(number_of_frames,
+                                                          xyz_lines)
+    comments = trj_lines[:, 1].tolist()
+    coord_lines = trj_lines[:, 2:].ravel().tolist()
+    atoms = np.array([line.split()[0]
+                      for line in coord_lines[:number_of_atoms]])
+    # np.loadtxt converts the coordinates in C. Items after the z
+    # coordinate are ignored.
+    coords = np.loadtxt(coord_lines, usecols=(1, 2, 3), comments=None,
+                        dtype=np.float64, ndmin=2)
+    coords = coords.reshape(number_of_frames, number_of_atoms, 3)
+    return atoms, coords, comments
+
+
+def parse_trj_file_bulk(trj_fn):
+    with open(trj_fn) as handle:
+        trj_str = handle.read()
+
+    return parse_trj_str_bulk(trj_str)
+
+
+def _build_xyz_cache(xyz_fn):
+    atoms, coords = parse_xyz_file(xyz_fn)
+    return {"coords": coords}, {"atoms": list(atoms)}
+
+
+def _build_trj_cache(trj_fn):
+    atoms, coords, comments = parse_trj_file_bulk(trj_fn)
+    return {"coords": coords}, {"atoms": atoms.tolist(), "comments": comments}
+
+
+def parse_xyz_file_cached(xyz_fn, cache_dir=None, max_bytes=None,
+                          check_hash=True):
+    """Like parse_xyz_file, but the coordinates are stored in a binary
+    cache and memory-mapped on later calls. See qchelper.cache.load_cached
+    for the meaning of the keyword arguments."""
+    arrays, meta = load_cached(xyz_fn, "xyz", _build_xyz_cache, cache_dir,
+                               max_bytes, check_hash)
+    return tuple(meta["atoms"]), arrays["coords"]
+
+
+def parse_trj_file_cached(trj_fn, cache_dir=None, max_bytes=None,
+                          check_hash=True):
+    """Like parse_trj_file_bulk, but the coordinates are stored in a binary
+    cache and memory-mapped on later calls. See qchelper.cache.load_cached
+    for the meaning of the keyword arguments."""
+    arrays, meta = load_cached(trj_fn, "trj", _build_trj_cache, cache_dir,
+                               max_bytes, check_hash)
+    return np.array(meta["atoms"]), arrays["coords"], meta["comments"]
+
+
+def interpolate_coords(coords1, coords2, steps=10):
+    """Linear interpolation between two sets of coordinates.
+
+    Leading dimensions are broadcast, so many start/end pairs can be
+    interpolated at once.
+
+    Parameters
+    ----------
+    coords1 : array_like
+        Shape (..., N, 3) start coordinates.
+    coords2 : array_like
+        Shape (..., N, 3) end coordinates.
+    steps : int, optional
+        Number of images between the start and the end.
+
+    Returns
+    -------
+    images : np.array
+        Shape (..., steps+2, N, 3) holding the start, the interpolated
+        images and the end.
+    """
+    coords1 = np.asarray(coords1, dtype=float)
+    coords2 = np.asarray(coords2, dtype=float)
+    fractions = np.linspace(0, 1, steps+2)[:, None, None]
+    diff = coords2 - coords1
+    images = coords1[..., None, :, :] + fractions * diff[..., None, :, :]
+    # Avoid rounding errors in the last image
+    images[..., -1, :, :] = coords2
+    return images
+
+
+class InterpolatedCartesians(Sequence):
+    """Sequence of interpolated geometries. The chemcoord Cartesians are
+    only created when an item is requested."""
+
+    def __init__(self, atoms, coords, columns):
+        self.atoms = atoms
+        self.coords = coords
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.coords)
+
+    def make_cartesian(self, coords):
+        values = np.zeros((self.atoms.size, 4), dtype="object")
+        values[:,0] = self.atoms
+        values[:,1:] = coords
+        frame = DataFrame.from_records(values, columns=self.columns)
+        return cc.Cartesian(frame)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.make_cartesian(coords) for coords in self.coords[key]]
+        return self.make_cartesian(self.coords[key])
+
+
 def interpolate_cartesians(cart1, cart2, steps=10):
-    """Interpolate from cart1 to cart2."""
+    """Interpolate from cart1 to cart2.
+
+    Returns an InterpolatedCartesians sequence of length steps+2. The
+    coordinates of all images are available as its coords attribute.
+    """
     atoms = cart1.frame.values[:,0]
     cart1a, cart2a = cart1.align(cart2)
-    coords1 = cart1a.frame.values[:,1:]
-    coords2 = cart2a.frame.values[:,1:]
-    diff = coords2-coords1
-    diff_per_step = diff/steps
-    carts = [cart1a, ]
-    for i in range(steps):
-        tmp_coords = coords1 + i*diff_per_step
-        print(tmp_coords.size)
-        print(tmp_coords.shape)
-        tmp_values = np.zeros((atoms.size, 4), dtype="object")
-        tmp_values[:,0] = atoms
-        tmp_values[:,1:] = tmp_coords
-        tmp_frame = DataFrame.from_records(tmp_values,
-                                        columns=cart1a.columns.values)
-        tmp_cart = cc.Cartesian(tmp_frame)
-        carts.append(tmp_cart)
-    carts.append(cart2a)
-    return carts
+    coords1 = cart1a.frame.values[:,1:].astype(float)
+    coords2 = cart2a.frame.values[:,1:].astype(float)
+    images = interpolate_coords(coords1, coords2, steps)
+    return InterpolatedCartesians(atoms, images, cart1a.columns.values)
 
 if __name__ == "__main__":
     start_fn = "/scratch/xyz/start.xyz"
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""Collect properties from many ORCA outputs into one table."""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+
+from qchelper.cache import compare_signature, file_signature, hash_file
+from qchelper.conversion import invcm2eV
+from qchelper.parser.Orca import Orca
+
+MANIFEST_VERSION = 1
+
+
+def _scf_e(orca):
+    return orca.parse_scf_e()
+
+
+def _ets(orca):
+    return orca.parse_actual_ets()
+
+
+def _etenergies(orca):
+    return invcm2eV(orca.data.etenergies)
+
+
+def _imgvibfreqs(orca):
+    return orca.imgvibfreqs
+
+
+# Property name: (extractor, cclib attributes needed by the extractor)
+PROPERTIES = {
+    "scf_e": (_scf_e, ()),
+    "ets": (_ets, ("etenergies", )),
+    "etenergies": (_etenergies, ("etenergies", )),
+    "imgvibfreqs": (_imgvibfreqs, ("vibfreqs", )),
+}
+
+
+def _to_json(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def harvest_file(fn, properties):
+    """Parse the requested properties from one ORCA output.
+
+    Returns a dict with the property names as keys and a dict holding an
+    error message for every property that couldn't be parsed."""
+    attributes = set()
+    for prop in properties:
+        attributes.update(PROPERTIES[prop][1])
+    results = dict()
+    errors = dict()
+    with Orca(fn, attributes=tuple(sorted(attributes))) as orca:
+        for prop in properties:
+            extractor, _ = PROPERTIES[prop]
+            try:
+                results[prop] = _to_json(extractor(orca))
+            except Exception as err:
+                results[prop] = None
+                errors[prop] = repr(err)
+    return results, errors
+
+
+def load_manifest(manifest_fn):
+    try:
+        with open(manifest_fn) as handle:
+            manifest = json.load(handle)
+    except FileNotFoundError:
+        return dict()
+    if manifest.get("version") != MANIFEST_VERSION:
+        return dict()
+    return manifest["entries"]
+
+
+def save_manifest(manifest_fn, entries):
+    tmp_fn = f"{manifest_fn}.{os.getpid()}.tmp"
+    with open(tmp_fn, "w") as handle:
+        json.dump({"version": MANIFEST_VERSION, "entries": entries}, handle,
+                  ignore_nan=True)
+    os.replace(tmp_fn, manifest_fn)
+
+
+def harvest_orca(fns, properties=("scf_e", ), workers=1, manifest_fn=None):
+    """Harvest properties from many ORCA outputs.
+
+    Parameters
+    ----------
+    fns : iterable of str
+        Paths to ORCA outputs, e.g. from paths.search_files_with_ext.
+    properties : iterable of str, optional
+        Keys of PROPERTIES that are parsed from every file.
+    workers : int, optional
+        Number of processes used for parsing.
+    manifest_fn : str, optional
+        JSON file holding size, mtime, hash and the parsed results of every
+        file. On a rerun only new or changed files and missing properties
+        are parsed; the other results are taken from the manifest.
+
+    Returns
+    -------
+    table : pd.DataFrame
+        One row per file (indexed by the absolute path) and one column per
+        property. Properties that couldn't be parsed are None.
+    """
+    fns = [os.path.abspath(fn) for fn in fns]
+    properties = list(properties)
+    entries = load_manifest(manifest_fn) if manifest_fn else dict()
+
+    # Properties that have to be parsed for every file
+    todo = dict()
+    for fn in fns:
+        entry = entries.get(fn)
+        if entry is None:
+            unchanged, signature = False, file_signature(fn, with_hash=False)
+        else:
+            unchanged, signature = compare_signature(entry, fn)
+        if not unchanged:
+            # Reuse the hash, if compare_signature already calculated it
+            if "sha256" not in signature:
+                signature = dict(signature, sha256=hash_file(fn))
+            entries[fn] = dict(signature, results=dict(), errors=dict())
+            todo[fn] = properties
+            continue
+        # Only touched or copied, but the content is still the same
+        entry.update(signature)
+        missing = [prop for prop in properties
+                   if prop not in entry["results"]]
+        if missing:
+            todo[fn] = missing
+
+    def store(fn, results, errors):
+        entries[fn]["results"].update(results)
+        entries[fn]["errors"].update(errors)
+        for prop, error in errors.items():
+            logging.error(f"Could not parse '{prop}' from '{fn}': {error}")
+
+    try:
+        if workers == 1:
+            for fn, props in todo.items():
+                store(fn, *harvest_file(fn, props))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(harvest_file, fn, props): fn
+                           for fn, props in todo.items()}
+                for future in as_completed(futures):
+                    fn = futures[future]
+                    try:
+                        store(fn, *future.result())
+                    except Exception as err:
+                        # E.g. a BrokenProcessPool after a worker crashed.
+                        # No results are stored, so the properties are
+                        # parsed again on the next run.
+                        store(fn, dict(), {prop: repr(err)
+                                           for prop in todo[fn]})
+    finally:
+        # Keep everything parsed so far, even if harvesting was aborted
+        if manifest_fn:
+            save_manifest(manifest_fn, entries)
+
+    columns = {prop: [entries[fn]["results"].get(prop) for fn in fns]
+               for prop in properties}
+    return pd.DataFrame(columns, index=pd.Index(fns, name="fn"))
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
 import os
 
 from natsort import natsorted
+import numpy as np
 import orbkit as ok
+from orbkit.qcinfo import QCinfo
+
+from qchelper.cache import load_cached
 
 ITYPES = {
     ".fchk": "gaussian.fchk",
@@ -13,13 +19,15 @@ ITYPES = {
 }
 
 
-def orbkit_can_parse(path):
+def orbkit_can_parse(path, index=None):
     """Checks a path for files that can be parsed by orbkit and returns
-    them as a list."""
+    them as a list. If a paths.FileIndex containing path is given, the
+    directory listing is taken from it."""
 
     fns = list()
     abs_fns = list()
-    for fn in os.listdir(path):
+    listing = index.listdir(path) if index is not None else os.listdir(path)
+    for fn in listing:
         ext = os.path.splitext(fn)[1]
         if ext in ITYPES:
             abspath = os.path.abspath(os.path.join(path, fn))
@@ -39,12 +47,127 @@ def orbkit_read(fn):
     return ok.read.main_read(fn, itype=itype, all_mo=True)
 
 
-def orbkit_loader(path):
-    """Scan a directory for files that can be parsed by orbkit and return
-    them as a list of QCinfo objects and a list containing the filenames."""
+def _to_json(value):
+    """Convert NumPy arrays and scalars in value to plain Python objects."""
+    if isinstance(value, dict):
+        return {key: _to_json(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(val) for val in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def _build_qcinfo_cache(fn):
+    qcinfo = orbkit_read(fn)
+    # The primitive exponents and contraction coefficients of all AOs are
+    # kept in one array.
+    ao_coeffs = [np.asarray(ao["coeffs"], dtype=float).reshape(-1, 2)
+                 for ao in qcinfo.ao_spec]
+    ao_spec = [_to_json({key: val for key, val in ao.items()
+                         if key != "coeffs"})
+               for ao in qcinfo.ao_spec]
+    mo_spec = [_to_json({key: val for key, val in mo.items()
+                         if key != "coeffs"})
+               for mo in qcinfo.mo_spec]
+    arrays = {
+        "geo_spec": np.asarray(qcinfo.geo_spec, dtype=float),
+        "ao_coeffs": (np.concatenate(ao_coeffs) if ao_coeffs
+                      else np.zeros((0, 2))),
+        "mo_coeffs": np.array([mo["coeffs"] for mo in qcinfo.mo_spec],
+                              dtype=float),
+    }
+    meta = {
+        "geo_info": _to_json(qcinfo.geo_info),
+        "ao_spec": ao_spec,
+        "ao_spherical": _to_json(getattr(qcinfo, "ao_spherical", None)),
+        "mo_spec": mo_spec,
+        "etot": _to_json(getattr(qcinfo, "etot", None)),
+    }
+    return arrays, meta
+
+
+def orbkit_read_cached(fn, cache_dir=None, max_bytes=None, check_hash=True):
+    """Like orbkit_read, but the parsed geometry, AO spec and MO
+    coefficients are stored in a binary cache. Later calls memory-map the
+    MO coefficient matrix instead of parsing fn again. See
+    qchelper.cache.load_cached for the meaning of the keyword arguments."""
+    arrays, meta = load_cached(fn, "qcinfo", _build_qcinfo_cache, cache_dir,
+                               max_bytes, check_hash)
+    qcinfo = QCinfo()
+    qcinfo.geo_spec = arrays["geo_spec"]
+    qcinfo.geo_info = np.array(meta["geo_info"])
+    offset = 0
+    qcinfo.ao_spec = list()
+    for ao in meta["ao_spec"]:
+        prim_num = ao["pnum"]
+        ao["coeffs"] = arrays["ao_coeffs"][offset:offset+prim_num]
+        offset += prim_num
+        qcinfo.ao_spec.append(ao)
+    if meta["ao_spherical"] is not None:
+        qcinfo.ao_spherical = [tuple(aos) for aos in meta["ao_spherical"]]
+    qcinfo.mo_spec = list()
+    for mo, coeffs in zip(meta["mo_spec"], arrays["mo_coeffs"]):
+        mo["coeffs"] = coeffs
+        qcinfo.mo_spec.append(mo)
+    if meta["etot"] is not None:
+        qcinfo.etot = meta["etot"]
+    return qcinfo
+
+
+def _read(abs_fn, cache, cache_dir, max_bytes):
+    if cache:
+        return orbkit_read_cached(abs_fn, cache_dir, max_bytes)
+    return orbkit_read(abs_fn)
+
+
+def iter_orbkit_loader(path, cache=False, cache_dir=None, max_bytes=None,
+                       workers=1):
+    """Scan a directory for files that can be parsed by orbkit and yield
+    (fn, qcinfo) tuples.
+
+    With workers > 1 the files are parsed in a process pool and yielded as
+    soon as they are finished, otherwise in natsorted order. Files that
+    can't be parsed are reported as error and skipped."""
 
     fns, abs_fns = orbkit_can_parse(path)
-    qcinfos = [orbkit_read(abs_fn) for abs_fn in abs_fns]
+    read_args = (cache, cache_dir, max_bytes)
+    if workers == 1:
+        for fn, abs_fn in zip(fns, abs_fns):
+            try:
+                qcinfo = _read(abs_fn, *read_args)
+            except Exception as err:
+                logging.error(f"Could not parse '{abs_fn}': {err!r}")
+                continue
+            yield fn, qcinfo
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_read, abs_fn, *read_args): (fn, abs_fn)
+                   for fn, abs_fn in zip(fns, abs_fns)}
+        for future in as_completed(futures):
+            fn, abs_fn = futures[future]
+            try:
+                qcinfo = future.result()
+            except Exception as err:
+                logging.error(f"Could not parse '{abs_fn}': {err!r}")
+                continue
+            yield fn, qcinfo
+
+
+def orbkit_loader(path, cache=False, cache_dir=None, max_bytes=None,
+                  workers=1):
+    """Scan a directory for files that can be parsed by orbkit and return
+    them as a list of QCinfo objects and a list containing the filenames.
+
+    With cache=True the files are read with orbkit_read_cached. With
+    workers > 1 the files are parsed in a process pool. Both lists keep the
+    natsorted order and files that can't be parsed are left out."""
+
+    loaded = dict(iter_orbkit_loader(path, cache, cache_dir, max_bytes,
+                                     workers))
+    fns = [fn for fn in orbkit_can_parse(path)[0] if fn in loaded]
+    qcinfos = [loaded[fn] for fn in fns]
     return qcinfos, fns
 
 
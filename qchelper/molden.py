@@ -1,8 +1,35 @@
+from collections import namedtuple
+import mmap
 import re
 import textwrap
 
+import numpy as np
 import pyparsing as pp
 
+MoldenMOs = namedtuple("MoldenMOs", "syms energies spins occups coeffs")
+
+# Matches the consecutive header lines (Sym=, Ene=, ...) starting a MO block
+MO_HEADER_BLOCK_PATTERN = r"(?:^[ \t]*(?:Sym|Ene|Spin|Occup)[ \t]*=.*(?:\n|\Z))+"
+MO_HEADER_BLOCK_RE = re.compile(MO_HEADER_BLOCK_PATTERN, re.MULTILINE)
+MO_HEADER_BLOCK_RE_B = re.compile(MO_HEADER_BLOCK_PATTERN.encode(),
+                                  re.MULTILINE)
+SECTION_PATTERN = r"^[ \t]*\[([^\]]+)\]"
+SECTION_RE = re.compile(SECTION_PATTERN, re.MULTILINE)
+SECTION_RE_B = re.compile(SECTION_PATTERN.encode(), re.MULTILINE)
+# Matches a single MO header line and captures key and value
+MO_HEADER_LINE_PATTERN = r"^[ \t]*(Sym|Ene|Spin|Occup)[ \t]*=[ \t]*(.*?)\s*$"
+MO_HEADER_LINE_RE = re.compile(MO_HEADER_LINE_PATTERN, re.MULTILINE)
+MO_HEADER_LINE_RE_B = re.compile(MO_HEADER_LINE_PATTERN.encode(),
+                                 re.MULTILINE)
+# index is the 1-based position of the MO in the file
+MO_HEADER_DTYPE = np.dtype([
+    ("index", np.int64),
+    ("sym", "U16"),
+    ("energy", np.float64),
+    ("spin", "U5"),
+    ("occup", np.float64),
+])
+
 
 def get_occupations(text):
     occup_re = "\s*Occup=\s*([-\d\.].+)"
@@ -25,36 +52,247 @@ def get_energies(text):
     return ens
 
 
+MO_HEADER_KEYS = ("Sym", "Ene", "Spin", "Occup")
+
+
+def _find_header_line(buf, keys, header_re, newline, pos, endpos):
+    """Offset of the next MO header line starting with one of keys, or -1.
+
+    Only literal searches run over the coefficient lines, which is much
+    faster than trying the anchored header regex at every offset."""
+    while True:
+        hits = [hit for hit in [buf.find(key, pos, endpos) for key in keys]
+                if hit != -1]
+        if not hits:
+            return -1
+        hit = min(hits)
+        line_start = buf.rfind(newline, 0, hit) + 1
+        if header_re.match(buf, line_start, endpos):
+            return line_start
+        pos = hit + 1
+
+
+def scan_mo_headers(buf, pos=0, endpos=None):
+    """Collect the Sym/Ene/Spin/Occup header lines of all MOs.
+
+    Only the header lines are parsed. After the first MO block the start of
+    the next block is located by a literal search for the key of its first
+    header line, so the coefficient lines are skipped.
+
+    Parameters
+    ----------
+    buf : str or bytes-like
+        Contents of a .molden file, e.g. a mmap object.
+    pos : int, optional
+        Offset where the scan starts.
+    endpos : int, optional
+        Offset where the scan stops.
+
+    Returns
+    -------
+    headers : np.array
+        Structured array with MO_HEADER_DTYPE, holding one entry per MO in
+        the order of the file. Missing values are empty strings or NaN.
+    """
+    if endpos is None:
+        endpos = len(buf)
+    if isinstance(buf, str):
+        header_re, decode, newline = MO_HEADER_LINE_RE, str, "\n"
+        keys = MO_HEADER_KEYS
+    else:
+        header_re, decode, newline = MO_HEADER_LINE_RE_B, bytes.decode, b"\n"
+        keys = [key.encode() for key in MO_HEADER_KEYS]
+
+    mos = list()
+    while pos < endpos:
+        line_start = _find_header_line(buf, keys, header_re, newline, pos,
+                                       endpos)
+        if line_start == -1:
+            break
+        if mos:
+            # The search key may not be on the first header line of this
+            # block, so also take the header lines right before it.
+            while line_start > pos:
+                prev = buf.rfind(newline, pos, line_start - 1)
+                prev = pos if prev == -1 else prev + 1
+                if not header_re.match(buf, prev, endpos):
+                    break
+                line_start = prev
+        else:
+            # All further blocks are found by the key of the first line
+            keys = [header_re.match(buf, line_start, endpos).group(1), ]
+
+        current = dict()
+        while line_start < endpos:
+            mobj = header_re.match(buf, line_start, endpos)
+            if mobj is None:
+                break
+            key, value = decode(mobj.group(1)), decode(mobj.group(2))
+            # A repeated key starts the next MO
+            if key in current:
+                mos.append(current)
+                current = dict()
+            current[key] = value
+            line_end = buf.find(newline, mobj.start(1), endpos)
+            line_start = endpos if line_end == -1 else line_end + 1
+        mos.append(current)
+        pos = line_start
+
+    headers = np.zeros(len(mos), dtype=MO_HEADER_DTYPE)
+    headers["index"] = np.arange(1, len(mos)+1)
+    headers["sym"] = [mo.get("Sym", "") for mo in mos]
+    headers["energy"] = [mo.get("Ene", "nan") for mo in mos]
+    headers["spin"] = [mo.get("Spin", "") for mo in mos]
+    headers["occup"] = [mo.get("Occup", "nan") for mo in mos]
+    return headers
+
+
+def scan_molden_headers(molden_fn):
+    """Like scan_mo_headers, but the .molden file is memory-mapped."""
+    with open(molden_fn, "rb") as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return scan_mo_headers(buf)
+
+
+def jmol_order(headers):
+    """Sort MO headers by energy, as done by Jmol. The position in the
+    returned array plus 1 is the Jmol MO index."""
+    return headers[np.argsort(headers["energy"], kind="stable")]
+
+
+def select_mos(headers, spin=None, energy=None):
+    """Boolean mask of the MOs with the given spin and/or energy."""
+    mask = np.ones(len(headers), dtype=bool)
+    if spin is not None:
+        mask &= headers["spin"] == spin
+    if energy is not None:
+        mask &= headers["energy"] == energy
+    return mask
+
+
+def _with_jmol_index(ordered, mask=None):
+    jmol_indices = np.arange(1, len(ordered)+1)
+    if mask is not None:
+        ordered, jmol_indices = ordered[mask], jmol_indices[mask]
+    # Insert a space after the MO number
+    # 40a' will become 40 a'
+    return [(int(i), float(mo["energy"]), re.sub("(\d+)", r"\1 ", mo["sym"]),
+             float(mo["occup"]))
+            for i, mo in zip(jmol_indices, ordered)]
+
+
 def get_jmol_ordering(text):
-    ens = get_energies(text)
-    syms = get_symmetries(text)
-    occups = get_occupations(text)
-    zipped = zip(ens, syms, occups)
-    sorted_by_energy = sorted(zipped, key=lambda mo: mo[0])
-    with_index = [(i+1, en, sym, occ)
-                  for i, (en, sym, occ) in enumerate(sorted_by_energy)]
-    return with_index
+    ordered = jmol_order(scan_mo_headers(text))
+    return _with_jmol_index(ordered)
 
 
 def get_jmol_active_space(text):
-    with_index = get_jmol_ordering(text)
-    active_space = [mo for mo in with_index
-                    if (mo[1] == 0.0)]
-    return active_space
+    ordered = jmol_order(scan_mo_headers(text))
+    # The active space is marked by an orbital energy of 0.0
+    return _with_jmol_index(ordered, select_mos(ordered, energy=0.0))
+
+
+def index_molden(buf):
+    """Byte (or character) offsets of the sections and MO blocks.
+
+    Parameters
+    ----------
+    buf : str or bytes-like
+        Contents of a .molden file, e.g. a mmap object.
+
+    Returns
+    -------
+    sections : dict
+        Lower case section names (e.g. "atoms", "gto", "mo") as keys and
+        (start, end) tuples as values. start points at the opening bracket.
+    mo_blocks : np.array
+        Shape (n_mo, 2) holding (start, end) of every MO block, starting at
+        its first header line.
+    """
+    if isinstance(buf, str):
+        section_re, header_re = SECTION_RE, MO_HEADER_BLOCK_RE
+        decode = str
+    else:
+        section_re, header_re = SECTION_RE_B, MO_HEADER_BLOCK_RE_B
+        decode = bytes.decode
+
+    section_mobjs = list(section_re.finditer(buf))
+    section_ends = ([mobj.start() for mobj in section_mobjs[1:]]
+                    + [len(buf), ])
+    sections = dict()
+    for mobj, end in zip(section_mobjs, section_ends):
+        name = decode(mobj.group(1)).strip().lower()
+        sections.setdefault(name, (mobj.start(), end))
+
+    mo_starts = list()
+    if "mo" in sections:
+        mo_start, mo_end = sections["mo"]
+        mo_starts = [mobj.start() for mobj
+                     in header_re.finditer(buf, mo_start, mo_end)]
+        mo_ends = mo_starts[1:] + [mo_end, ]
+    mo_blocks = np.array([(start, end) for start, end
+                          in zip(mo_starts, mo_ends)] if mo_starts else [],
+                         dtype=np.int64).reshape(-1, 2)
+    return sections, mo_blocks
+
+
+class MoldenFile:
+    """Memory-mapped .molden file with indexed sections and MO blocks.
+
+    Only the requested MOs are read and parsed.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._handle = open(fn, "rb")
+        self.buf = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sections, self.mo_blocks = index_molden(self.buf)
+
+    def close(self):
+        self.buf.close()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.mo_blocks)
+
+    def section(self, name):
+        """Returns the bytes of a section, including its [Name] line."""
+        start, end = self.sections[name.lower()]
+        return self.buf[start:end]
+
+    def mo_block(self, index):
+        start, end = self.mo_blocks[index]
+        return self.buf[start:end]
+
+    def headers(self):
+        """Returns the MO headers as structured array, see
+        scan_mo_headers."""
+        return scan_mo_headers(self.buf, *self.sections["mo"])
+
+    def read_mos(self, indices=None):
+        """Parse the MOs with the given indices. All MOs are read if no
+        indices are given. Returns a MoldenMOs namedtuple."""
+        if indices is None:
+            indices = range(len(self))
+        text = b"".join([self.mo_block(index).rstrip() + b"\n"
+                         for index in indices]).decode()
+        return parse_molden_mos_np(text)
 
 
 def cut_molden(text, indices):
     """Used to shrink a NTO-.molden-file from ORCA."""
-    # Split at [MO]
-    header, mos = re.split("\[MO\]", text)
-    # Never matches the last MO
-    # This is actually a pretty bad hack ;(
-    mos = re.findall("(Sym=.+?)(?=Sym)", text, re.DOTALL)
-
-    mos_slice = [mos[index].strip() for index in indices]
+    sections, mo_blocks = index_molden(text)
+    header = text[:sections["mo"][0]]
+    mos_slice = [text[slice(*mo_blocks[index])].strip() for index in indices]
 
     # Rename the orbitals, because ORCA uses '1a' for all MOs
-    occ_mos = [re.sub("(Sym=\s*)(\d+)", "Sym= {}".format(i), mo)
+    occ_mos = [re.sub("(Sym=\s*)(\d+)", "Sym= {}".format(i), mo, count=1)
                for i, mo in enumerate(mos_slice, 1)]
 
     # Reconstruct .molden-file
@@ -63,6 +301,20 @@ def cut_molden(text, indices):
     return new_molden
 
 
+def cut_molden_file(molden_fn, out_fn, indices):
+    """Like cut_molden, but only the header and the selected MO blocks are
+    copied from the memory-mapped input file to out_fn."""
+    with MoldenFile(molden_fn) as molden, open(out_fn, "wb") as handle:
+        handle.write(molden.buf[:molden.sections["mo"][0]])
+        handle.write(b"[MO]\n")
+        for i, index in enumerate(indices, 1):
+            if i > 1:
+                handle.write(b"\n")
+            mo = molden.mo_block(index).strip()
+            handle.write(re.sub(rb"(Sym=\s*)(\d+)", f"Sym= {i}".encode(), mo,
+                                count=1))
+
+
 def parse_molden_mos(text):
     """Expects everything after the [MO] tag of a .molden file."""
     int_ = pp.Word(pp.nums).setParseAction(
@@ -72,8 +324,8 @@ def parse_molden_mos(text):
                                         lambda s, loc, toks: float(toks[0])
     )
     ene = pp.Literal("Ene=") + float_.setResultsName("energy")
-    a_or_b = pp.Or(pp.Literal("Alpha").setResultsName("spin"),
-                   pp.Literal("Beta").setResultsName("spin"))
+    a_or_b = pp.Or([pp.Literal("Alpha").setResultsName("spin"),
+                    pp.Literal("Beta").setResultsName("spin")])
     spin = pp.Literal("Spin=") + a_or_b
     occup = pp.Literal("Occup=") + float_.setResultsName("occup")
     ao_line = pp.Suppress(int_) + float_
@@ -93,6 +345,68 @@ def parse_molden_mos(text):
     return mos
 
 
+def parse_mo_header(header_text):
+    """Returns a dict holding the 'Key= value' pairs of a MO header."""
+    header = dict()
+    for line in header_text.strip().split("\n"):
+        key, value = line.split("=", 1)
+        header[key.strip()] = value.strip()
+    return header
+
+
+def parse_molden_mos_np(text):
+    """Parse the MOs of a .molden file into NumPy arrays.
+
+    Expects everything after the [MO] tag of a .molden file. Following
+    sections are ignored. The coefficients of every MO block are converted
+    in one NumPy call.
+
+    Parameters
+    ----------
+    text : str
+        MO section of a .molden file.
+
+    Returns
+    -------
+    mos : MoldenMOs
+        Namedtuple holding the symmetries, energies, spins and
+        occupations as arrays of shape (n_mo, ) and the coefficients as
+        contiguous float64 array of shape (n_mo, n_ao). Coefficients that
+        are missing in the file are zero.
+    """
+    # Drop following sections
+    section_end = text.find("\n[")
+    if section_end != -1:
+        text = text[:section_end]
+
+    header_mobjs = list(MO_HEADER_BLOCK_RE.finditer(text))
+    block_ends = [mobj.start() for mobj in header_mobjs[1:]] + [len(text), ]
+    mo_num = len(header_mobjs)
+    syms = list()
+    energies = np.zeros(mo_num)
+    spins = list()
+    occups = np.zeros(mo_num)
+    blocks = list()
+    for i, (mobj, block_end) in enumerate(zip(header_mobjs, block_ends)):
+        header = parse_mo_header(mobj.group(0))
+        syms.append(header.get("Sym", ""))
+        energies[i] = float(header.get("Ene", "nan"))
+        spins.append(header.get("Spin", "Alpha"))
+        occups[i] = float(header.get("Occup", "nan"))
+        # Rows of (AO index, coefficient)
+        block = np.array(text[mobj.end():block_end].split(),
+                         dtype=np.float64).reshape(-1, 2)
+        blocks.append(block)
+
+    ao_num = max([int(block[:,0].max()) for block in blocks if block.size],
+                 default=0)
+    coeffs = np.zeros((mo_num, ao_num))
+    for i, block in enumerate(blocks):
+        coeffs[i, block[:,0].astype(int)-1] = block[:,1]
+    return MoldenMOs(np.array(syms), energies, np.array(spins), occups,
+                     coeffs)
+
+
 def join_parsed_mo(mo):
     ao_line_strs = [f"{i: 5d} {coeff: 16.10f}" for i, coeff in enumerate(mo.coeffs, 1)]
     ao_str = "\n ".join(ao_line_strs)
@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
 
 
 def comp_coeffs(mo1, mo2):
@@ -55,7 +60,78 @@ def get_degenerate_indices(values, thresh=1e-6):
     # generacy, but this is currently not handled.
 
 
-def compare_mos(mos1, mos2, check_neighbours=0):
+def mo_distance_matrix(mos1, mos2):
+    """Phase-invariant distances between all MOs in mos1 and mos2.
+
+    min(|mo1 - mo2|, |mo1 + mo2|) is calculated for all pairs at once,
+    using |mo1 -+ mo2|^2 = |mo1|^2 + |mo2|^2 -+ 2 mo1.mo2.
+    Returns an array of shape (len(mos1), len(mos2)).
+    """
+    mos1 = np.asarray(mos1, dtype=float)
+    mos2 = np.asarray(mos2, dtype=float)
+    sq_norms1 = (mos1**2).sum(axis=1)
+    sq_norms2 = (mos2**2).sum(axis=1)
+    dots = mos1 @ mos2.T
+    sq_dists = sq_norms1[:,None] + sq_norms2[None,:] - 2*np.abs(dots)
+    # Clip small negative values caused by rounding errors
+    return np.sqrt(np.clip(sq_dists, 0, None))
+
+
+def banded_mo_distances(mos1, mos2, check_neighbours):
+    """Phase-invariant distances only for pairs with |i - j| <=
+    check_neighbours. Returns a sparse matrix of shape
+    (len(mos1), len(mos2)) holding the distances plus 1, so that zero
+    distances are kept as explicit entries."""
+    mos1 = np.asarray(mos1, dtype=float)
+    mos2 = np.asarray(mos2, dtype=float)
+    sq_norms1 = (mos1**2).sum(axis=1)
+    sq_norms2 = (mos2**2).sum(axis=1)
+    rows = list()
+    cols = list()
+    data = list()
+    # Calculate the distances diagonal by diagonal
+    for offset in range(-check_neighbours, check_neighbours+1):
+        i = np.arange(max(0, -offset), min(len(mos1), len(mos2)-offset))
+        j = i + offset
+        dots = (mos1[i] * mos2[j]).sum(axis=1)
+        sq_dists = sq_norms1[i] + sq_norms2[j] - 2*np.abs(dots)
+        rows.append(i)
+        cols.append(j)
+        data.append(np.sqrt(np.clip(sq_dists, 0, None)) + 1)
+    return csr_matrix((np.concatenate(data),
+                       (np.concatenate(rows), np.concatenate(cols))),
+                      shape=(len(mos1), len(mos2)))
+
+
+def match_mos(mos1, mos2, check_neighbours=0):
+    """Globally optimal one-to-one matching of the MOs in mos1 and mos2.
+
+    The sum of the phase-invariant distances of the matched pairs is
+    minimized with the Hungarian algorithm. With check_neighbours > 0 only
+    MOs whose indices differ by at most check_neighbours are considered and
+    the assignment is solved on a sparse, banded distance matrix, which is
+    suitable for very large basis sets.
+
+    Returns a list of tuples like compare_mos.
+    """
+    mos1 = np.asarray(mos1, dtype=float)
+    mos2 = np.asarray(mos2, dtype=float)
+    if check_neighbours == 0:
+        dists = mo_distance_matrix(mos1, mos2)
+        rows, cols = linear_sum_assignment(dists)
+    else:
+        dists = banded_mo_distances(mos1, mos2, check_neighbours)
+        rows, cols = min_weight_full_bipartite_matching(dists)
+        order = np.argsort(rows)
+        rows, cols = rows[order], cols[order]
+    # Recalculate the norms of the matched pairs directly, as the
+    # expanded form above suffers from cancellation for similar MOs.
+    norms = np.minimum(np.linalg.norm(mos1[rows] - mos2[cols], axis=1),
+                       np.linalg.norm(mos1[rows] + mos2[cols], axis=1))
+    return list(zip(rows, cols, norms))
+
+
+def compare_mos(mos1, mos2, check_neighbours=0, optimal=False):
     """Accepts two iterables containing iterables with mo ceofficents. For
     every MO in mos1 the functions looks for the most similar MO in mos2. This
     is done by comparing the norm of the difference vector of the two MO
@@ -63,12 +139,17 @@ def compare_mos(mos1, mos2, check_neighbours=0):
     Returns a list of tuples, where the tuple contains the index of the MO in
     mos1, the index of the most similar MO in mo2 and the norm of the
     difference vector of the two MOs.
+    With optimal=True the greedy search is replaced by the global
+    assignment of match_mos.
     """
+    if optimal:
+        return match_mos(mos1, mos2, check_neighbours)
+
     similar_mos = list()
     already_matched = list()
     for i, mo1 in enumerate(mos1):
         # Compare all mos
-        if check_neighbours is 0:
+        if check_neighbours == 0:
             lower_bound = 0
             upper_bound = None
         else:
@@ -104,6 +185,114 @@ def compare_mos(mos1, mos2, check_neighbours=0):
                             modifiable_norms.min()))
     return similar_mos
 
+def mo_overlaps(coeffs1, coeffs2, ao_overlap):
+    """MO overlap matrices C1 S C2^T.
+
+    Parameters
+    ----------
+    coeffs1 : np.array
+        Shape (..., n_mo, n_ao) MO coefficients.
+    coeffs2 : np.array
+        Shape (..., n_mo, n_ao) MO coefficients.
+    ao_overlap : np.array
+        Shape (..., n_ao, n_ao) AO overlap matrix between the basis
+        functions of coeffs1 and coeffs2.
+
+    Returns
+    -------
+    overlaps : np.array
+        Shape (..., n_mo, n_mo).
+    """
+    return coeffs1 @ ao_overlap @ np.swapaxes(coeffs2, -1, -2)
+
+
+def assign_mo_overlaps(overlaps):
+    """Match MOs by maximizing the sum of the absolute MO overlaps.
+
+    Returns the index of the matched MO of the second set and its phase
+    for every MO of the first set."""
+    rows, cols = linear_sum_assignment(-np.abs(overlaps))
+    phases = np.where(overlaps[rows, cols] < 0, -1, 1)
+    return cols, phases
+
+
+def _track_pair(coeffs1, coeffs2, ao_overlap):
+    return assign_mo_overlaps(mo_overlaps(coeffs1, coeffs2, ao_overlap))
+
+
+def track_mos(coeffs, ao_overlaps, workers=1):
+    """Follow MOs along a scan or trajectory.
+
+    Consecutive steps are matched through their S-weighted MO overlaps.
+
+    Parameters
+    ----------
+    coeffs : sequence of np.array
+        K arrays of shape (n_mo, n_ao) holding the MO coefficients of
+        every step.
+    ao_overlaps : np.array
+        AO overlap matrix of shape (n_ao, n_ao) used for all steps, or
+        shape (K-1, n_ao, n_ao) holding the AO overlaps between the basis
+        functions of step k and k+1.
+    workers : int, optional
+        Number of processes used to match the step pairs. With 1 all
+        overlaps are calculated in one batched matrix product.
+
+    Returns
+    -------
+    permutations : np.array
+        Shape (K, n_mo). MO i of the first step corresponds to MO
+        permutations[k, i] of step k.
+    phases : np.array
+        Shape (K, n_mo). Sign that has to be applied to
+        coeffs[k][permutations[k, i]] to continue MO i of the first step
+        with the same phase.
+    """
+    coeffs = np.asarray(coeffs, dtype=float)
+    ao_overlaps = np.asarray(ao_overlaps, dtype=float)
+    step_num, mo_num, ao_num = coeffs.shape
+    if ao_overlaps.ndim == 2:
+        ao_overlaps = np.broadcast_to(ao_overlaps,
+                                      (step_num-1, ) + ao_overlaps.shape)
+    if ao_overlaps.shape != (step_num-1, ao_num, ao_num):
+        raise ValueError(f"AO overlaps of shape {ao_overlaps.shape} don't "
+                         f"match {step_num} steps with {ao_num} AOs. Are "
+                         "the MO coefficients spherical and the AO overlaps "
+                         "cartesian (or vice versa)?")
+
+    if workers == 1:
+        overlaps = mo_overlaps(coeffs[:-1], coeffs[1:], ao_overlaps)
+        pair_results = [assign_mo_overlaps(ovlp) for ovlp in overlaps]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pair_results = list(pool.map(_track_pair, coeffs[:-1],
+                                         coeffs[1:], ao_overlaps))
+
+    permutations = np.zeros((step_num, mo_num), dtype=int)
+    phases = np.ones((step_num, mo_num), dtype=int)
+    permutations[0] = np.arange(mo_num)
+    for k, (cols, pair_phases) in enumerate(pair_results):
+        prev = permutations[k]
+        permutations[k+1] = cols[prev]
+        phases[k+1] = phases[k] * pair_phases[prev]
+    return permutations, phases
+
+
+def qcinfo_mo_coeffs(qcinfo):
+    """Returns the MO coefficients of a QCinfo object as
+    (n_mo, n_ao) array."""
+    return np.array([mo["coeffs"] for mo in qcinfo.mo_spec], dtype=float)
+
+
+def track_qcinfo_mos(qcinfos, ao_overlaps, workers=1):
+    """Follow the MOs of a sequence of QCinfo objects. The AO overlaps have
+    to be given in the same AO basis as the MO coefficients, i.e.
+    spherical if qcinfo.ao_spherical is set. See track_mos for the
+    arguments and the returned arrays."""
+    coeffs = [qcinfo_mo_coeffs(qcinfo) for qcinfo in qcinfos]
+    return track_mos(coeffs, ao_overlaps, workers)
+
+
 if __name__ == "__main__":
     import orbkit as ok
     print("G09")
@@ -1,9 +1,209 @@
-from subprocess import Popen, PIPE
+from collections import namedtuple
+import codecs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import queue
+import re
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+import threading
+import time
 
-def call_mwfn(inp_fn, stdin):
+MwfnResult = namedtuple("MwfnResult", "inp_fn log_fn returncode timed_out")
+
+
+def call_mwfn(inp_fn, stdin, timeout=None):
     mwfn_cmd = ["Multiwfn", inp_fn]
     proc = Popen(mwfn_cmd, universal_newlines=True,
                  stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate(stdin)
+    try:
+        stdout, stderr = proc.communicate(stdin, timeout=timeout)
+    except TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
     proc.terminate()
     return stdout, stderr
+
+
+def run_mwfn_job(inp_fn, stdin, log_fn, timeout=None):
+    """Run Multiwfn on inp_fn and write stdout and stderr to log_fn.
+
+    A job that runs longer than timeout seconds is killed. Returns a
+    MwfnResult."""
+    mwfn_cmd = ["Multiwfn", inp_fn]
+    with open(log_fn, "w") as log_handle:
+        proc = Popen(mwfn_cmd, universal_newlines=True,
+                     stdin=PIPE, stdout=log_handle, stderr=STDOUT)
+        timed_out = False
+        try:
+            proc.communicate(stdin, timeout=timeout)
+        except TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            timed_out = True
+    return MwfnResult(inp_fn, log_fn, proc.returncode, timed_out)
+
+
+def run_mwfn_jobs(jobs, workers=None, timeout=None, log_dir=None):
+    """Run many Multiwfn jobs with a bounded number of concurrent processes.
+
+    Parameters
+    ----------
+    jobs : iterable
+        (inp_fn, stdin) tuples, where stdin is the menu script sent to
+        Multiwfn.
+    workers : int, optional
+        Maximum number of concurrent Multiwfn processes. Defaults to the
+        number of CPUs.
+    timeout : float, optional
+        Seconds after which a job is killed.
+    log_dir : str, optional
+        Directory for the log files. Defaults to the directory of the
+        respective input file.
+
+    Yields
+    ------
+    result : MwfnResult
+        One result per job, in the order the jobs finish. The output of a
+        job is found in result.log_fn.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = list()
+        for i, (inp_fn, stdin) in enumerate(jobs):
+            dirname, basename = os.path.split(inp_fn)
+            if log_dir is not None:
+                dirname = log_dir
+            # The job index keeps the logs of several jobs on the same
+            # input file apart.
+            log_fn = os.path.join(dirname, f"{basename}.{i}.mwfn.log")
+            futures.append(pool.submit(run_mwfn_job, inp_fn, stdin, log_fn,
+                                       timeout))
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class MwfnSession:
+    """Drive one long-running Multiwfn process over stdin and stdout.
+
+    The wavefunction is loaded only once. Every script passed to run has to
+    bring Multiwfn back to the main menu. Its output ends when the main menu
+    was printed again and no further output arrived for settle seconds.
+    If that doesn't happen in time, Multiwfn is killed and the session is
+    closed.
+
+    Parameters
+    ----------
+    inp_fn : str
+        Wavefunction file loaded by Multiwfn.
+    timeout : float, optional
+        Seconds to wait for the main menu before a TimeoutError is raised.
+    settle : float, optional
+        Seconds without new output after the main menu, before the output
+        is considered complete.
+    """
+
+    MAIN_MENU_RE = re.compile(r"Main function menu")
+
+    def __init__(self, inp_fn, timeout=600, settle=0.2):
+        self.inp_fn = inp_fn
+        self.timeout = timeout
+        self.settle = settle
+        self.closed = False
+
+        # Don't let the Fortran runtimes buffer stdout when it is a pipe.
+        env = dict(os.environ, GFORTRAN_UNBUFFERED_PRECONNECTED="y",
+                   FORT_BUFFERED="false")
+        self.proc = Popen(["Multiwfn", inp_fn], stdin=PIPE, stdout=PIPE,
+                          stderr=STDOUT, bufsize=0, env=env)
+        self._chunks = queue.Queue()
+        self._reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self._reader.start()
+        # Output of loading the wavefunction
+        self.startup_output = self._read_until_main_menu()
+
+    def _read_stdout(self):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        fd = self.proc.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            self._chunks.put(decoder.decode(chunk))
+        # Signal the end of the output
+        self._chunks.put(None)
+
+    def _read_until_main_menu(self):
+        output = list()
+        menu_seen = False
+        deadline = time.monotonic() + self.timeout
+        while True:
+            wait = self.settle if menu_seen else deadline - time.monotonic()
+            if wait <= 0:
+                # Multiwfn is stuck somewhere in its menus and its pending
+                # output would be mixed into the output of the next script.
+                self.kill()
+                raise TimeoutError("Multiwfn didn't return to the main "
+                                   "menu. Output so far:\n" + "".join(output))
+            try:
+                chunk = self._chunks.get(timeout=wait)
+            except queue.Empty:
+                if menu_seen:
+                    return "".join(output)
+                continue
+            if chunk is None:
+                self.kill()
+                raise RuntimeError("Multiwfn exited unexpectedly. Output:\n"
+                                   + "".join(output))
+            output.append(chunk)
+            # The marker could be split over two chunks
+            menu_seen = menu_seen or bool(
+                self.MAIN_MENU_RE.search("".join(output[-2:]))
+            )
+
+    def run(self, stdin):
+        """Send a menu script to Multiwfn and return its output."""
+        if self.closed:
+            raise RuntimeError("The Multiwfn session is closed.")
+        if not stdin.endswith("\n"):
+            stdin += "\n"
+        self.proc.stdin.write(stdin.encode())
+        self.proc.stdin.flush()
+        return self._read_until_main_menu()
+
+    def run_many(self, stdins):
+        """Run several scripts one after another on the loaded
+        wavefunction. Returns a list holding the output of every script."""
+        return [self.run(stdin) for stdin in stdins]
+
+    def kill(self):
+        """Kill Multiwfn and close the session."""
+        self.closed = True
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdin.close()
+        self._reader.join(timeout=1)
+
+    def close(self):
+        self.closed = True
+        if self.proc.poll() is None:
+            try:
+                # Exit from the main menu
+                self.proc.stdin.write(b"q\n")
+                self.proc.stdin.close()
+                self.proc.wait(timeout=10)
+            except (BrokenPipeError, TimeoutExpired):
+                self.proc.kill()
+                self.proc.wait()
+        self._reader.join(timeout=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
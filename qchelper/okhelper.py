@@ -1,11 +1,28 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from functools import lru_cache
 
-from jinja2 import Template
 import numpy as np
 
+# Number of basis function per AO
+FUNCS_PER_AO = {
+    "s": 1,
+    "p": 3,
+    "d": 5,
+    "f": 7,
+    "g": 9,
+}
+
+# Order of the header lines of a MO block
+MOLDEN_LAYOUTS = {
+    # Layout of the former molden.tpl
+    "molden": ("Sym", "Spin", "Ene", "Occup"),
+    # Layout of the former mwfn_molden.tpl, expected by Multiwfn
+    "mwfn": ("Sym", "Ene", "Spin", "Occup"),
+}
+
 
 def ao_order_from_qcinfo(qcinfo):
     """Get the ordering of the basis functions (AOs) from a QCInfo object.
@@ -35,6 +52,9 @@ def get_verbose_aos(qcinfo):
         "s": ["s", ],
         "p": ["px", "py", "pz"],
         "d": ["dz2", "dxz", "dyz", "dx2-y2", "dxy"],
+        "f": ["fz3", "fxz2", "fyz2", "fz(x2-y2)", "fxyz", "fx(x2-3y2)",
+              "fy(3x2-y2)"],
+        "g": ["g0", "g+1", "g-1", "g+2", "g-2", "g+3", "g-3", "g+4", "g-4"],
     }
     verbose_aos = list()
     for ao in qcinfo.ao_spec:
@@ -42,10 +62,64 @@ def get_verbose_aos(qcinfo):
     return verbose_aos
 
 
-def qcinfo_to_molden(qcinfo, fn):
+def write_molden(handle, atoms, aos_per_atom, mos, layout="molden"):
+    """Stream a .molden file section by section to an open text handle.
+
+    The coefficients of a MO are formatted with a single %-operation using
+    a format string that is built only once for all MOs.
+
+    Parameters
+    ----------
+    handle : file object
+        Opened for writing in text mode.
+    atoms : iterable
+        Holding [element, number, Z, x, y, z] for every atom.
+    aos_per_atom : OrderedDict
+        AOs per atom as returned by get_aos_per_atom.
+    mos : iterable of dict
+        MOs holding the keys "sym", "energy", "occ_num" and "coeffs".
+    layout : str, optional
+        Order of the MO header lines. One of the keys of MOLDEN_LAYOUTS.
+    """
+    header_keys = MOLDEN_LAYOUTS[layout]
+
+    handle.write("[Molden Format]\n[Atoms] AU\n")
+    atom_fmt = " % 3s %4g %3g % 3.6f % 3.6f % 3.6f\n"
+    handle.write("".join([atom_fmt % tuple(atom) for atom in atoms]))
+    handle.write("[5D7F]\n[GTO]\n")
+    for i, aos in enumerate(aos_per_atom.values(), 1):
+        handle.write(f"{i} 0")
+        for ao in aos:
+            handle.write("\n%s %s 1.00" % (ao["type"], ao["pnum"]))
+            prim_coeffs = np.asarray(ao["coeffs"], dtype=float)
+            handle.write(("\n% 1.10E % 1.10E" * len(prim_coeffs))
+                         % tuple(prim_coeffs.ravel().tolist()))
+        handle.write("\n\n")
+
+    handle.write("\n[MO]")
+    coeffs_fmt = None
+    coeffs_num = None
+    for mo in mos:
+        header_values = {
+            "Sym": mo["sym"],
+            "Spin": "Alpha",
+            "Ene": "% .6f" % mo["energy"],
+            "Occup": "% .6f" % mo["occ_num"],
+        }
+        handle.write("".join([f"\n{key}= {header_values[key]}"
+                              for key in header_keys]))
+        coeffs = np.asarray(mo["coeffs"], dtype=float)
+        if (coeffs_fmt is None) or (len(coeffs) != coeffs_num):
+            coeffs_num = len(coeffs)
+            # The AO indices are the same for all MOs, so they are put
+            # directly into the format string.
+            coeffs_fmt = "".join(["\n%4g %% .6f" % i
+                                  for i in range(1, coeffs_num+1)])
+        handle.write(coeffs_fmt % tuple(coeffs.tolist()))
+
+
+def qcinfo_to_molden(qcinfo, fn, layout="molden"):
     """Write information from a QCInfo object to a molden file."""
-    with open("/home/carpx/Code/qchelper/qchelper/templates/molden.tpl") as handle:
-        tpl = Template(handle.read())
     atoms = [[element, int(float(number)), int(float(Z))]
              for element, number, Z in qcinfo.geo_info]
     geo_spec = qcinfo.geo_spec.astype("float")
@@ -53,9 +127,8 @@ def qcinfo_to_molden(qcinfo, fn):
         atoms[i].extend(coords)
     aos_per_atom = get_aos_per_atom(qcinfo)
     mos = qcinfo.mo_spec
-    rendered = tpl.render(atoms=atoms, aos_per_atom=aos_per_atom, mos=mos)
     with open(fn, "w") as handle:
-        handle.write(rendered)
+        write_molden(handle, atoms, aos_per_atom, mos, layout)
 
 
 def get_aos_per_atom(qcinfo):
@@ -67,59 +140,74 @@ def get_aos_per_atom(qcinfo):
     return aos_per_atom
 
 
+def get_basis_signature(qcinfo):
+    """Returns a hashable tuple holding (atom, AO type) for every AO."""
+    return tuple((ao["atom"], ao["type"]) for ao in qcinfo.ao_spec)
+
+
+@lru_cache(maxsize=128)
+def _ao_permutation(basis_signature, target_order):
+    # AO indices per atom and type, in the original order
+    aos_per_atom = OrderedDict()
+    for i, (atom, ao_type) in enumerate(basis_signature):
+        aos_per_type = aos_per_atom.setdefault(atom, OrderedDict())
+        aos_per_type.setdefault(ao_type, deque()).append(i)
+
+    ao_perm = list()
+    for atom, new_order in target_order:
+        aos_per_type = aos_per_atom[atom]
+        ao_perm.extend([aos_per_type[ao_type].popleft()
+                        for ao_type in new_order])
+
+    func_nums = [FUNCS_PER_AO[ao_type] for _, ao_type in basis_signature]
+    offsets = np.cumsum([0, ] + func_nums)
+    func_perm = np.concatenate([np.arange(offsets[i], offsets[i+1])
+                                for i in ao_perm] or [np.zeros(0, int)])
+    ao_perm = np.array(ao_perm, dtype=int)
+    # The arrays are shared between all callers
+    ao_perm.flags.writeable = False
+    func_perm.flags.writeable = False
+    return ao_perm, func_perm
+
+
+def ao_permutation(qcinfo, ao_order_dict):
+    """Permutation that brings the AOs of a qcinfo into a new order.
+
+    The permutation only depends on the AO types per atom and the target
+    order, so it is calculated once and cached for all calculations
+    sharing the same basis.
+
+    Returns
+    -------
+    ao_perm : np.array
+        Indices of the ao_spec entries in the new order.
+    func_perm : np.array
+        Indices of the basis functions (MO coefficients) in the new order.
+    """
+    basis_signature = get_basis_signature(qcinfo)
+    atoms = OrderedDict.fromkeys(atom for atom, _ in basis_signature)
+    target_order = tuple((atom, tuple(ao_order_dict[atom]))
+                         for atom in atoms)
+    return _ao_permutation(basis_signature, target_order)
+
+
 def reorder_qcinfo_aos(qcinfo, ao_order_dict):
     """Reorders the AOs in a qcinfo in place."""
-    # Number of basis function per AO
-    funcs_per_ao = {
-        "s": 1,
-        "p": 3,
-        "d": 5,
-        "f": 7,
-    }
-    aos = qcinfo.ao_spec
-    ao_types = [ao["type"] for ao in aos]
-    func_nums = [funcs_per_ao[aot] for aot in ao_types]
-    offset = 0
+    ao_perm, func_perm = ao_permutation(qcinfo, ao_order_dict)
+
     # Contains the offsets of the mo coefficients
-    for i, funcn in enumerate(func_nums):
-        upper_bound = offset + funcn
-        qcinfo.ao_spec[i]["slice"] = (offset, upper_bound)
+    offset = 0
+    for ao in qcinfo.ao_spec:
+        upper_bound = offset + FUNCS_PER_AO[ao["type"]]
+        ao["slice"] = (offset, upper_bound)
         offset = upper_bound
 
-    # AO_spec in Basisfukntionen pro center splitten
-    aos_per_atom = get_aos_per_atom(qcinfo)
-
-    ordered_ao_spec = list()
-    ordered_aos = list()
-    for atom in aos_per_atom:
-        aos_on_atom = aos_per_atom[atom]
-
-        """Create one dict per atom. Keep the AOs in this dict
-        with the corresponding type as key.
-        {
-            "s": [ao1, ao2, ...],
-            "p": [ao3, ...],
-            ...
-        }"""
-        aos_per_type = OrderedDict()
-        for ao in aos_on_atom:
-            aos_per_type.setdefault(ao["type"], list()).append(ao)
-
-        new_order = ao_order_dict[atom]
-        ordered_aos_on_atom = list()
-        for ao_type in new_order:
-            # Pop an AO of this type from the lists that are stored
-            # in the aos_per_type dict.
-            ao = aos_per_type[ao_type].pop(0)
-            # Save the AO in the new ordered ao_spec
-            ordered_ao_spec.append(ao)
-            # Expand the stored slice into a list of integers and
-            # keep them in the ordered index array.
-            ordered_aos_on_atom.extend(list(range(*ao["slice"])))
-        ordered_aos.extend(ordered_aos_on_atom)
-    qcinfo.ao_spec = ordered_ao_spec
-    for mo in qcinfo.mo_spec:
-        mo["coeffs"] = mo["coeffs"][ordered_aos]
+    qcinfo.ao_spec = [qcinfo.ao_spec[i] for i in ao_perm]
+    # Reorder the coefficients of all MOs in one indexing operation
+    coeffs = np.array([mo["coeffs"] for mo in qcinfo.mo_spec])
+    coeffs = coeffs[:, func_perm]
+    for mo, mo_coeffs in zip(qcinfo.mo_spec, coeffs):
+        mo["coeffs"] = mo_coeffs
 
 if __name__ == "__main__":
     import orbkit as ok
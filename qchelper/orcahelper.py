@@ -5,6 +5,8 @@ NTO-molden-files created by ORCA."""
 
 import argparse
 from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
 import re
 import sys
@@ -14,6 +16,8 @@ from natsort import natsorted
 import numpy as np
 import yaml
 
+from qchelper.molden import scan_molden_headers
+
 NTOPair = namedtuple("NTOPair", "state weight from_mo to_mo from_fn to_fn")
 
 TPL= """
@@ -61,11 +65,10 @@ def get_nto_pairs(molden_fn, uhf=False):
 
     mobj = re.match(fn_re, molden_fn)
     base_fn, mult, state = mobj.groups()
-    with open(molden_fn) as handle:
-        text = handle.read()
-    occs = [float(occ) for occ
-            in re.findall("Occup=\s*([\d\.]+)", text)]
-    spins = re.findall("Spin=\s*(\w+)", text)
+    # Only the MO header lines are parsed, the coefficients are skipped.
+    headers = scan_molden_headers(molden_fn)
+    occs = headers["occup"].tolist()
+    spins = headers["spin"].tolist()
     assert((len(occs) % 2 == 0) and
            (len(spins) % 2 == 0) and
            (len(occs) == len(spins)))
@@ -123,10 +126,17 @@ def states_to_yaml(states):
     return yaml.dump(states_dict)
 
 
-def get_jmol_nto_script(molden_fns, base_path, img_base_path, orient, uhf):
+def get_jmol_nto_script(molden_fns, base_path, img_base_path, orient, uhf,
+                        workers=1):
     full_molden_fns = [os.path.join(base_path, mfn) for mfn in molden_fns]
-    states = [(mfn, get_nto_pairs(fmfn, uhf=uhf))
-               for mfn, fmfn in zip(molden_fns, full_molden_fns)]
+    if workers == 1:
+        nto_pairs = [get_nto_pairs(fmfn, uhf=uhf) for fmfn in full_molden_fns]
+    else:
+        # The state files are independent, so they are scanned concurrently.
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            nto_pairs = list(pool.map(partial(get_nto_pairs, uhf=uhf),
+                                      full_molden_fns))
+    states = list(zip(molden_fns, nto_pairs))
     tpl = Template(TPL)
     rendered = tpl.render(states=states,
                           orient=orient,
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import mmap
+import os
 import re
 
 from cclib.parser import ORCA
@@ -8,16 +10,102 @@ import numpy as np
 from qchelper.conversion import invcm2eV, au2eV
 from qchelper.parser.Parser import Parser
 
+# Section headers whose byte offsets are collected in Orca.sections
+SECTION_HEADERS = {
+    "scf_energy": "FINAL SINGLE POINT ENERGY",
+    "transition_dipoles": "TRANSITION ELECTRIC",
+    "mayer": "Mayer bond orders larger than 0.1",
+    "opt_cycle": "GEOMETRY OPTIMIZATION CYCLE",
+}
+SECTIONS_RE = re.compile("|".join(
+    [f"(?P<{key}>{re.escape(header)})"
+     for key, header in SECTION_HEADERS.items()]).encode()
+)
+
+SCF_ENERGY_RE = "FINAL SINGLE POINT ENERGY\s*([-\.\d]+)"
+MAYER_RE = "Mayer bond orders larger than 0.1\s*(.+?)\n\n"
+TRANSITION_DIPOLE_RE = "TRANSITION ELECTRIC.+?TZ(.+?)\n\n"
+
 class Orca(Parser):
 
-    def __init__(self, fn):
-        super().__init__(fn, parser=ORCA)
+    def __init__(self, fn, attributes=None):
+        super().__init__(fn, parser=ORCA, attributes=attributes)
+
+        self._buf = None
+        self._sections = None
+
+    @property
+    def buf(self):
+        """Read-only memory map of the output file. Empty files can't be
+        mapped, so empty bytes are used for them."""
+        if self._buf is None:
+            with open(self.fn, "rb") as handle:
+                if os.fstat(handle.fileno()).st_size == 0:
+                    self._buf = b""
+                else:
+                    self._buf = mmap.mmap(handle.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        return self._buf
+
+    def close(self):
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        self._buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def sections(self):
+        """Dict holding the byte offsets of every occurrence of the headers
+        in SECTION_HEADERS. Built in one pass over the file, that is shared
+        by all extractors."""
+        if self._sections is None:
+            self._sections = {key: list() for key in SECTION_HEADERS}
+            for mobj in SECTIONS_RE.finditer(self.buf):
+                self._sections[mobj.lastgroup].append(mobj.start())
+        return self._sections
+
+    def search_section(self, key, regex, index=0):
+        """Match regex at the index-th occurrence of a section.
+
+        The regex is first applied to the memory map, starting at the
+        section offset, to find the extent of the match. Only this slice is
+        decoded and matched again, so a str match object is returned.
+        Returns None if the section is missing.
+        """
+        offsets = self.sections[key]
+        if not offsets:
+            return None
+        offset = offsets[index]
+        mobj = re.compile(regex.encode(), re.DOTALL).match(self.buf, offset)
+        if mobj is None:
+            return None
+        text = self.buf[offset:mobj.end()].decode()
+        return re.match(regex, text, re.DOTALL)
 
     def parse_scf_e(self):
-        scf_energy_re = "FINAL SINGLE POINT ENERGY\s*([-\.\d]+)"
-        scf_energy = float(re.search(scf_energy_re, self.text).groups()[0])
+        mobj = self.search_section("scf_energy", SCF_ENERGY_RE)
+        scf_energy = float(mobj.groups()[0])
         return au2eV(scf_energy)
 
+    def parse_scf_energies(self):
+        """SCF energies in eV of all FINAL SINGLE POINT ENERGY lines,
+        e.g. one per optimization cycle."""
+        scf_energies = [
+            float(self.search_section("scf_energy", SCF_ENERGY_RE, i)
+                  .groups()[0])
+            for i in range(len(self.sections["scf_energy"]))
+        ]
+        return au2eV(np.array(scf_energies))
+
+    @property
+    def opt_cycle_num(self):
+        return len(self.sections["opt_cycle"])
+
     def parse_actual_ets(self):
         """Parse ground and excited state energies using cclib.
 
@@ -47,15 +135,13 @@ class Orca(Parser):
         return all_energies
 
     def parse_mayer(self):
-        mayer_re = "Mayer bond orders larger than 0.1\s*(.+?)\n\n"
-        matches = re.search(mayer_re, self.text, re.DOTALL)
+        matches = self.search_section("mayer", MAYER_RE)
         #print(matches.groups()[0].split())
         #matches = [m.strip() for m in matches.groups()[1split(":")
         
         return matches
 
     def parse_tddft_table(self):
-        transition_dipole_re = "TRANSITION ELECTRIC.+?TZ(.+?)\n\n"
-        mobj = re.search(transition_dipole_re, self.text, re.DOTALL)
+        mobj = self.search_section("transition_dipoles", TRANSITION_DIPOLE_RE)
         table_lines = mobj.groups()[0].split("\n")[3:]
         return [l.split() for l in table_lines]
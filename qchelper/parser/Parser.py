@@ -1,18 +1,67 @@
 #!/usr/bin/env python3
 
+from types import MethodType
+
+from cclib.parser.logfileparser import StopParsing
 import numpy as np
 
 from qchelper.conversion import invcm2eV
 
 class Parser:
 
-    def __init__(self, fn, parser):
+    def __init__(self, fn, parser, attributes=None):
+        """Wrapper around a cclib parser.
+
+        cclib only runs when data is accessed for the first time, so the
+        regex based extractors working on text don't trigger it.
+
+        Parameters
+        ----------
+        fn : str
+             .log file to be parsed.
+        parser : class
+                 cclib parser class, e.g. cclib.parser.ORCA.
+        attributes : iterable of str, optional
+                 cclib attributes that are needed, e.g. ("etenergies", ).
+                 cclib stops reading the file as soon as all of them are
+                 set, so attributes that are printed repeatedly (e.g. the
+                 scfenergies of an optimization) only hold their first
+                 occurrences.
+        """
         self.fn = fn
-        self.parser = parser(self.fn)
+        self.parser_cls = parser
+        self.attributes = attributes
 
-        self.data = self.parser.parse()
+        self._parser = None
+        self._data = None
         self._text = None
 
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = self.parser_cls(self.fn)
+            if self.attributes:
+                self._stop_when_parsed(self._parser, self.attributes)
+        return self._parser
+
+    @staticmethod
+    def _stop_when_parsed(parser, attributes):
+        extract = parser.extract
+
+        # cclib checks the signature of extract, so it has to stay a
+        # method taking (self, inputfile, line).
+        def extract_until_parsed(self, inputfile, line):
+            extract(inputfile, line)
+            if all(hasattr(self, attr) for attr in attributes):
+                raise StopParsing()
+        parser.extract = MethodType(extract_until_parsed, parser)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.parser.parse()
+        return self._data
+
     @property
     def text(self):
         if self._text is None:
@@ -1,11 +1,101 @@
 #!/usr/bin/env python3
 
-import itertools
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import json
 import os
 import re
 
 
-def search_recursivly(top, fn_re):
+def _make_matcher(ext=None, fn_re=None):
+    """Returns a function checking a filename against an extension and a
+    regex. The regex is compiled only once."""
+    regex = re.compile(fn_re) if fn_re is not None else None
+
+    def match(fn):
+        if (ext is not None) and not fn.endswith(ext):
+            return False
+        return (regex is None) or (regex.match(fn) is not None)
+    return match
+
+
+def _scan_dir(path, match, ignore_fns):
+    """List one directory. Returns the matched files and the subdirectories
+    that have to be searched."""
+    files = list()
+    dirs = list()
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Ignored directories are pruned, as every path below them
+                # would contain the ignored string, too.
+                if any(ignore_fn in entry.path for ignore_fn in ignore_fns):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # Like os.walk, don't descend into symlinked directories
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                elif match(entry.name):
+                    files.append(entry.path)
+    except OSError:
+        # Unreadable directories are skipped, like in os.walk
+        pass
+    return files, dirs
+
+
+def iter_files(top, ext=None, fn_re=None, ignore_fns=(), workers=1):
+    """Search recursivly for files and yield their paths as they are found.
+
+    Parameters
+    ----------
+    top : str
+        Path to the root dir from where the search starts.
+    ext : str, optional
+        Only yield files with this extension.
+    fn_re : str, optional
+        Only yield files whose names match this regular expression.
+    ignore_fns : iterable of str, optional
+        Skip files and directories if their path contains a string from
+        this iterable.
+    workers : int, optional
+        Number of threads listing directories. With 1 the directories are
+        visited in the same order as with os.walk.
+
+    Yields
+    ------
+    full_path : str
+        Full path to a found file.
+    """
+    match = _make_matcher(ext, fn_re)
+    ignore_fns = tuple(ignore_fns)
+
+    if workers == 1:
+        stack = [top, ]
+        while stack:
+            files, dirs = _scan_dir(stack.pop(), match, ignore_fns)
+            yield from files
+            stack.extend(reversed(dirs))
+        return
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {pool.submit(_scan_dir, top, match, ignore_fns), }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                pending.update([pool.submit(_scan_dir, dir_, match,
+                                            ignore_fns)
+                                for dir_ in dirs])
+                yield from files
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def search_recursivly(top, fn_re, workers=1):
     """Search recursivly for files that match a supplied regex.
 
     Parameters
@@ -14,6 +104,8 @@ def search_recursivly(top, fn_re):
         Path to the root dir from where the search starts.
     fn_re : str
         Valid regular expression that matches the wanted filenames.
+    workers : int, optional
+        Number of threads used for the search, see iter_files.
 
     Returns
     -------
@@ -21,14 +113,10 @@ def search_recursivly(top, fn_re):
         Full paths to the matched filenames.
     """
 
-    full_paths = list()
-    for root, dirs, files in os.walk(top):
-        matched = [fn for fn in files if re.match(fn_re, fn)]
-        full_paths.extend([os.path.join(root, fn) for fn in matched])
-    return full_paths
+    return list(iter_files(top, fn_re=fn_re, workers=workers))
 
 
-def search_files_with_ext(top, ext=".out", ignore_fns=[]):
+def search_files_with_ext(top, ext=".out", ignore_fns=[], workers=1):
     """Search recursivly for files with a certain extensions with the ability
     to ignore some of them.
 
@@ -40,6 +128,8 @@ def search_files_with_ext(top, ext=".out", ignore_fns=[]):
         File extension to search for.
     ignore_fns : iterable of str, optional
         Ignore found files if they contain a string from this iterable.
+    workers : int, optional
+        Number of threads used for the search, see iter_files.
 
     Returns
     -------
@@ -47,15 +137,126 @@ def search_files_with_ext(top, ext=".out", ignore_fns=[]):
         Full paths to the found files.
     """
 
-    full_paths = list()
-    for root, dirs, files in os.walk(top):
-        ext_fns = [fn for fn in files if fn.endswith(ext)]
-        full_paths.extend([os.path.join(root, ext_fn) for ext_fn in ext_fns])
+    return list(iter_files(top, ext=ext, ignore_fns=ignore_fns,
+                           workers=workers))
+
+
+class FileIndex:
+    """Persistent index of the files below a directory.
+
+    For every directory the mtime and the names of its files and
+    subdirectories are stored. As the mtime of a directory changes when
+    entries are added, removed or renamed, refresh only lists directories
+    whose mtime changed. Queries are answered from the index without
+    touching the filesystem.
+
+    Parameters
+    ----------
+    top : str
+        Path to the root dir of the index.
+    index_fn : str, optional
+        JSON file holding the index. Defaults to .qchelper_index.json in
+        top.
+    """
+
+    VERSION = 1
+
+    def __init__(self, top, index_fn=None):
+        self.top = top
+        if index_fn is None:
+            index_fn = os.path.join(top, ".qchelper_index.json")
+        self.index_fn = index_fn
+        # Keys are paths relative to top, "" being top itself
+        self.dirs = dict()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_fn) as handle:
+                index = json.load(handle)
+        except (FileNotFoundError, ValueError):
+            return
+        if ((index.get("version") == self.VERSION)
+                and (index["top"] == os.path.abspath(self.top))):
+            self.dirs = index["dirs"]
+
+    def save(self):
+        index = {
+            "version": self.VERSION,
+            "top": os.path.abspath(self.top),
+            "dirs": self.dirs,
+        }
+        tmp_fn = f"{self.index_fn}.{os.getpid()}.tmp"
+        with open(tmp_fn, "w") as handle:
+            json.dump(index, handle)
+        os.replace(tmp_fn, self.index_fn)
+
+    def refresh(self, save=True):
+        """Update the index. Only directories whose mtime changed are
+        listed again. Returns the number of listed directories."""
+        # Saving the index changes the mtime of its directory, so this
+        # directory is always listed again, but the index file itself is
+        # never part of the index.
+        index_fn = os.path.abspath(self.index_fn)
+        dirs = dict()
+        listed = 0
+        stack = ["", ]
+        while stack:
+            rel_dir = stack.pop()
+            path = os.path.join(self.top, rel_dir)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(rel_dir)
+            if (entry is None) or (entry["mtime_ns"] != mtime_ns):
+                files, subdirs = _scan_dir(path, lambda fn: True, ())
+                entry = {
+                    "mtime_ns": mtime_ns,
+                    "files": [os.path.basename(fn) for fn in files
+                              if os.path.abspath(fn) != index_fn],
+                    "dirs": [os.path.basename(dir_) for dir_ in subdirs],
+                }
+                listed += 1
+            dirs[rel_dir] = entry
+            stack.extend([os.path.join(rel_dir, dir_)
+                          for dir_ in reversed(entry["dirs"])])
+        self.dirs = dirs
+        if save:
+            self.save()
+        return listed
+
+    def listdir(self, path):
+        """Names of the files in one indexed directory."""
+        rel_dir = os.path.relpath(os.path.abspath(path),
+                                  os.path.abspath(self.top))
+        if rel_dir == ".":
+            rel_dir = ""
+        return list(self.dirs[rel_dir]["files"])
+
+    def iter_files(self, ext=None, fn_re=None, ignore_fns=()):
+        """Like the module level iter_files, but answered from the index."""
+        match = _make_matcher(ext, fn_re)
+        ignore_fns = tuple(ignore_fns)
+        stack = ["", ]
+        while stack:
+            rel_dir = stack.pop()
+            entry = self.dirs.get(rel_dir)
+            if entry is None:
+                continue
+            path = os.path.join(self.top, rel_dir)
+            for fn in entry["files"]:
+                full_path = os.path.join(path, fn)
+                if match(fn) and not any(ignore_fn in full_path
+                                         for ignore_fn in ignore_fns):
+                    yield full_path
+            stack.extend([os.path.join(rel_dir, dir_)
+                          for dir_ in reversed(entry["dirs"])
+                          if not any(ignore_fn in os.path.join(path, dir_)
+                                     for ignore_fn in ignore_fns)])
 
-    if ignore_fns:
-        return [full_path for full_path, ignore_fn
-                in itertools.product(full_paths, ignore_fns)
-                if ignore_fn not in full_path
-        ]
+    def search_recursivly(self, fn_re):
+        return list(self.iter_files(fn_re=fn_re))
 
-    return full_paths
+    def search_files_with_ext(self, ext=".out", ignore_fns=[]):
+        return list(self.iter_files(ext=ext, ignore_fns=ignore_fns))